@@ -20,6 +20,8 @@ from djvu.sexpr cimport cexpr_t, _WrappedCExpr
 from djvu.sexpr cimport public_c2py as cexpr2py
 from djvu.sexpr cimport public_py2c as py2cexpr
 
+from cpython.pythread cimport PyThread_type_lock
+
 cdef extern from 'libdjvu/ddjvuapi.h':
     struct ddjvu_context_s
     union ddjvu_message_s
@@ -186,14 +188,27 @@ cdef class Context
 
 cdef class Document
 
+cdef class RenderCache
+
 cdef class DocumentExtension:
     cdef Document _document
 
 cdef class DocumentPages(DocumentExtension):
-    pass
+    cdef object _page_refs
+    cdef ddjvu_pageinfo_t* _infos
+    cdef char* _have_infos
+    cdef int _n_infos
+    cdef Page get_page(self, int n)
+    cdef int get_cached_info(self, int n, ddjvu_pageinfo_t* info)
+    cdef object store_info(self, int n, ddjvu_pageinfo_t* info)
 
 cdef class DocumentFiles(DocumentExtension):
     cdef object _page_map
+    cdef ddjvu_fileinfo_t* _infos
+    cdef int _n_infos
+    cdef object _file_infos
+    cdef object _load_infos(self, int wait)
+    cdef File get_file(self, int n)
 
 cdef class Document:
     cdef ddjvu_document_t* ddjvu_document
@@ -202,9 +217,11 @@ cdef class Document:
     cdef DocumentFiles _files
     cdef object _queue
     cdef object _condition
+    cdef object _watchers
     cdef object __weakref__
     cdef object _init(self, Context context, ddjvu_document_t* ddjvu_document)
     cdef object _clear(self)
+    cdef object _get_all_pages(self)
 
 cdef class _SexprWrapper:
     cdef object _document_weakref
@@ -237,10 +254,12 @@ cdef class File:
     cdef object _get_info(self)
 
 cdef class Page:
+    cdef object __weakref__
     cdef Document _document
     cdef ddjvu_pageinfo_t ddjvu_pageinfo
     cdef int _have_info
     cdef int _n
+    cdef object _fetch_info(self)
     cdef object _get_info(self)
 
 cdef class PageAnnotations(Annotations):
@@ -255,6 +274,28 @@ cdef class PageText:
 cdef class Context:
     cdef ddjvu_context_t* ddjvu_context
     cdef object _queue
+    cdef object _condition
+    cdef object _watchers
+    cdef RenderCache _render_cache
+    cdef object _queue_limits
+    cdef object _queue_limit_types
+    cdef object _dropped_messages
+    cdef unsigned int _message_filter
+    cdef object _thread
+    cdef int _closed
+    cdef PyThread_type_lock _loft_lock
+    cdef object _document_loft
+    cdef object _document_weak_loft
+    cdef object _job_loft
+    cdef object _job_weak_loft
+    cdef object _check_open(self)
+    cdef object _get_queue_limit_type(self, message_type)
+    cdef object _put_message(self, object queue, Message message)
+
+cdef class ContextPool:
+    cdef object _contexts
+    cdef object _documents
+    cdef int _choose(self, key) except -1
 
 cdef class PixelFormat:
     cdef ddjvu_format_t* ddjvu_format
@@ -275,22 +316,62 @@ cdef class PixelFormatGrey(PixelFormat):
 
 cdef class PixelFormatPalette(PixelFormat):
     cdef unsigned int _palette[216]
+    cdef object _key
 
 cdef class PixelFormatPackedBits(PixelFormat):
     cdef int _little_endian
     pass
 
+cdef class _ImageMemory:
+    cdef char *memory
+    cdef Py_ssize_t size
+
+cdef class BufferPool:
+    cdef object _chunks
+    cdef Py_ssize_t _size
+    cdef Py_ssize_t _max_size
+    cdef object _lock
+    cdef PooledBuffer get_buffer(self, Py_ssize_t size)
+    cdef object put_memory(self, _ImageMemory chunk)
+
+cdef class PooledBuffer:
+    cdef BufferPool _pool
+    cdef _ImageMemory _chunk
+
+cdef class RenderCache:
+    cdef object _entries
+    cdef Py_ssize_t _size
+    cdef Py_ssize_t _max_size
+    cdef Py_ssize_t _hits
+    cdef Py_ssize_t _misses
+    cdef Py_ssize_t _evictions
+    cdef object _lock
+    cdef object lookup(self, object key)
+    cdef object store(self, object key, object data)
+
+cdef class ImageBuffer:
+    cdef PooledBuffer _data
+    cdef char *_buf
+    cdef const char *_format
+    cdef int _ndim
+    cdef int _contiguous
+    cdef Py_ssize_t _itemsize
+    cdef Py_ssize_t _shape[3]
+    cdef Py_ssize_t _strides[3]
+
 cdef class Job:
     cdef Context _context
     cdef ddjvu_job_t* ddjvu_job
     cdef object _queue
     cdef object _condition
+    cdef object _watchers
     cdef object _init(self, Context context, ddjvu_job_t *ddjvu_job)
     cdef object _clear(self)
+    cdef object _finish(self)
     cdef object __weakref__
 
 cdef class PageJob(Job):
-    pass
+    cdef Page _page
 
 cdef class SaveJob(Job):
     cdef object _file
@@ -32,20 +32,15 @@ include 'common.pxi'
 cdef object weakref
 import weakref
 
-cdef object thread
-IF PY3K:
-    import _thread as thread
-ELSE:
-    import thread
-
 cdef object Queue, Empty
 IF PY3K:
     from queue import Queue, Empty
 ELSE:
     from Queue import Queue, Empty
 
-cdef object Condition
-from threading import Condition
+cdef object Condition, Event, RLock, Semaphore, Thread, threading_Lock, current_thread
+from threading import Condition, Event, RLock, Semaphore, Thread, current_thread
+from threading import Lock as threading_Lock
 
 cdef object imap, izip
 IF PY3K:
@@ -59,6 +54,31 @@ import sys
 from os import devnull
 from traceback import format_exc
 
+cdef object os_path, makedirs
+import os.path as os_path
+from os import makedirs
+
+cdef object OrderedDict, deque, namedtuple
+from collections import OrderedDict, deque, namedtuple
+
+cdef object array
+from array import array
+
+cdef object struct_pack
+from struct import pack as struct_pack
+
+cdef object compressobj, crc32
+from zlib import compressobj, crc32
+
+cdef object mmap
+from mmap import mmap
+
+cdef object timer
+IF PY3K:
+    from time import perf_counter as timer
+ELSE:
+    from time import time as timer
+
 IF PY3K:
     cdef object memoryview
     from builtins import memoryview
@@ -75,13 +95,12 @@ from djvu.sexpr import Symbol, SymbolExpression, InvalidExpression
 cdef object the_sentinel
 the_sentinel = object()
 
-cdef object _context_loft, _document_loft, _document_weak_loft, _job_loft, _job_weak_loft
+# Documents and jobs are registered in lofts of their own context (see
+# Context._loft_lock). Only the context loft is global; it's modified only
+# when a context is created or closed.
+cdef object _context_loft
 cdef Lock loft_lock
 _context_loft = {}
-_document_loft = set()
-_document_weak_loft = weakref.WeakValueDictionary()
-_job_loft = set()
-_job_weak_loft = weakref.WeakValueDictionary()
 loft_lock = allocate_lock()
 
 cdef extern from 'libdjvu/ddjvuapi.h':
@@ -214,8 +233,13 @@ IF WINDOWS:
         int dup(int)
 ELSE:
     from posix.unistd cimport dup
+from cpython.buffer cimport PyBuffer_FillInfo
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_ND, PyBUF_STRIDES, PyBUF_WRITABLE
+from libc.limits cimport INT_MAX
 from libc.stdio cimport fclose
 from libc.stdio cimport fdopen
+from libc.string cimport memcpy
+from libc.string cimport memset
 
 IF HAVE_LANGINFO_H:
     cdef extern from 'langinfo.h':
@@ -240,6 +264,105 @@ cdef object check_sentinel(self, kwargs):
     if kwargs.get('sentinel') is not the_sentinel:
         raise_instantiation_error(type(self))
 
+cdef object watch(object condition, object watchers, object check, object fetch=None):
+    # Return an asyncio future, which is resolved in the event loop thread
+    # with the value returned by check(), as soon as it's not the_sentinel,
+    # or with the exception raised by check().
+    # check() is called right away, and then, in the message distributor
+    # thread, after every message that notifies the condition.
+    # If fetch is not None, check() only tells whether a result is ready,
+    # and the result is obtained by calling fetch() in the event loop thread,
+    # once it's known that the future has not been cancelled. If fetch()
+    # returns the_sentinel, the future waits for the next notification.
+    # This must be called from the event loop thread.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def resolve(result, exc):
+        if future.done():
+            return
+        if exc is None and fetch is not None:
+            try:
+                result = fetch()
+            except Exception as ex:
+                exc = ex
+            else:
+                if result is the_sentinel:
+                    # Somebody else was faster.
+                    with condition:
+                        if not poll():
+                            watchers.append(poll)
+                    return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+    def poll():
+        if future.done():
+            return True
+        exc = None
+        try:
+            result = check()
+        except Exception as ex:
+            result = None
+            exc = ex
+        else:
+            if result is the_sentinel:
+                return False
+        try:
+            loop.call_soon_threadsafe(resolve, result, exc)
+        except RuntimeError:
+            # The event loop is closed.
+            pass
+        return True
+    with condition:
+        if not poll():
+            watchers += [poll]
+    return future
+
+cdef object run_watchers(object watchers):
+    # Assumption: the condition protecting the watchers is already acquired.
+    if watchers:
+        watchers[:] = [watcher for watcher in watchers if not watcher()]
+
+cdef object get_message_nowait(object queue):
+    def fetch():
+        try:
+            return queue.get_nowait()
+        except Empty:
+            return the_sentinel
+    return fetch
+
+cdef object watch_queue(object condition, object watchers, object queue):
+    # Return an asyncio future, which is resolved with the next message from
+    # the queue. The message is dequeued only in the event loop thread, so
+    # that cancelling the future never loses it.
+    def check():
+        if queue.empty():
+            return the_sentinel
+    return watch(condition, watchers, check, get_message_nowait(queue))
+
+cdef object wait_for_sexpr(object obj):
+    def check():
+        try:
+            obj.sexpr
+        except NotAvailable:
+            return the_sentinel
+    return check
+
+cdef class _AsyncMessageIterator:
+
+    cdef object _owner
+
+    def __cinit__(self, owner):
+        self._owner = owner
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._owner.get_message_async()
+
 cdef object write_unraisable_exception(object cause):
     try:
         message = format_exc()
@@ -324,25 +447,91 @@ cdef class DocumentPages(DocumentExtension):
     Use document.pages to obtain instances of this class.
 
     Page indexing is zero-based, i.e. pages[0] stands for the very first page.
+    Slicing returns a list of pages.
 
     len(pages) might return 1 when called before receiving a DocInfoMessage.
+
+    Page objects are reused as long as they are referenced. Page information
+    (see Page.get_info()) is cached for the whole document, once the
+    document decoding is done.
     '''
 
     def __cinit__(self, Document document not None, **kwargs):
         check_sentinel(self, kwargs)
         self._document = document
+        self._page_refs = weakref.WeakValueDictionary()
+        self._infos = NULL
+        self._have_infos = NULL
+        self._n_infos = 0
 
     def __len__(self):
         return ddjvu_document_get_pagenum(self._document.ddjvu_document)
 
+    cdef Page get_page(self, int n):
+        cdef Page page
+        # Fast path: no lock is needed to find an existing page.
+        page = self._page_refs.get(n)
+        if page is None:
+            # Make sure that concurrent threads don't create distinct Page
+            # objects for the same page.
+            with self._document._condition:
+                page = self._page_refs.get(n)
+                if page is None:
+                    page = Page(self._document, n)
+                    self._page_refs[n] = page
+        return page
+
     def __getitem__(self, key):
         if is_int(key):
             if key < 0 or key >= len(self):
                 raise IndexError('page number out of range')
-            return Page(self.document, key)
+            return self.get_page(key)
+        elif typecheck(key, slice):
+            return [self.get_page(n) for n in range(*key.indices(len(self)))]
         else:
             raise TypeError('page numbers must be integers')
 
+    def __iter__(self):
+        cdef int n = 0
+        while n < ddjvu_document_get_pagenum(self._document.ddjvu_document):
+            yield self.get_page(n)
+            n += 1
+
+    cdef int get_cached_info(self, int n, ddjvu_pageinfo_t* info):
+        if n < 0 or n >= self._n_infos or not self._have_infos[n]:
+            return 0
+        info[0] = self._infos[n]
+        return 1
+
+    cdef object store_info(self, int n, ddjvu_pageinfo_t* info):
+        cdef int n_infos
+        if self._infos == NULL:
+            # The number of pages is not known for sure until the document
+            # decoding is done.
+            if not ddjvu_document_decoding_done(self._document.ddjvu_document):
+                return
+            with self._document._condition:
+                if self._infos == NULL:
+                    n_infos = ddjvu_document_get_pagenum(self._document.ddjvu_document)
+                    self._have_infos = <char*> py_malloc(n_infos)
+                    if self._have_infos == NULL:
+                        raise MemoryError('Unable to allocate {0} bytes for page information'.format(n_infos))
+                    memset(self._have_infos, 0, n_infos)
+                    self._infos = <ddjvu_pageinfo_t*> py_malloc(n_infos * sizeof(ddjvu_pageinfo_t))
+                    if self._infos == NULL:
+                        py_free(self._have_infos)
+                        self._have_infos = NULL
+                        raise MemoryError('Unable to allocate {0} bytes for page information'.format(n_infos * sizeof(ddjvu_pageinfo_t)))
+                    self._n_infos = n_infos
+        if n < 0 or n >= self._n_infos:
+            return
+        self._infos[n] = info[0]
+        self._have_infos[n] = 1
+
+    def __dealloc__(self):
+        py_free(self._infos)
+        py_free(self._have_infos)
+
 cdef class Page:
 
     '''
@@ -386,12 +575,25 @@ cdef class Page:
         def __get__(self):
             return Thumbnail(self)
 
-    cdef object _get_info(self):
+    cdef object _fetch_info(self):
+        # Return JobOK if the information is available, JobStarted if it is
+        # not available yet, or an exception class otherwise.
         cdef ddjvu_status_t status
+        cdef DocumentPages pages = self._document._pages
         if self._have_info:
-            return
+            return JobOK
+        if pages.get_cached_info(self._n, &self.ddjvu_pageinfo):
+            self._have_info = 1
+            return JobOK
         status = ddjvu_document_get_pageinfo(self._document.ddjvu_document, self._n, &self.ddjvu_pageinfo)
         ex = JobException_from_c(status)
+        if ex is JobOK:
+            self._have_info = 1
+            pages.store_info(self._n, &self.ddjvu_pageinfo)
+        return ex
+
+    cdef object _get_info(self):
+        ex = self._fetch_info()
         if ex is JobOK:
             return
         elif ex is JobStarted:
@@ -413,7 +615,6 @@ cdef class Page:
 
         Possible exceptions: NotAvailable, JobFailed.
         '''
-        cdef ddjvu_status_t status
         if self._have_info:
             return
         if not wait:
@@ -421,10 +622,8 @@ cdef class Page:
         while True:
             self._document._condition.acquire()
             try:
-                status = ddjvu_document_get_pageinfo(self._document.ddjvu_document, self._n, &self.ddjvu_pageinfo)
-                ex = JobException_from_c(status)
+                ex = self._fetch_info()
                 if ex is JobOK:
-                    self._have_info = 1
                     return
                 elif ex is JobStarted:
                     self._document._condition.wait()
@@ -433,6 +632,26 @@ cdef class Page:
             finally:
                 self._document._condition.release()
 
+    def get_info_async(self):
+        '''
+        P.get_info_async() -> an asyncio future
+
+        Asynchronous counterpart of P.get_info(wait=True).
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        cdef Document document
+        document = self._document
+        def check():
+            ex = self._fetch_info()
+            if ex is JobOK:
+                return
+            elif ex is JobStarted:
+                return the_sentinel
+            else:
+                raise ex
+        return watch(document._condition, document._watchers, check)
+
     property width:
         '''
         Return the page width, in pixels.
@@ -534,8 +753,9 @@ cdef class Page:
         '''
         cdef PageJob job
         cdef ddjvu_job_t* ddjvu_job
+        cdef Context context = self._document._context
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(context._loft_lock, WAIT_LOCK)
         try:
             ddjvu_job = <ddjvu_job_t*> ddjvu_page_create_by_pageno(self._document.ddjvu_document, self._n)
             if ddjvu_job == NULL:
@@ -543,9 +763,10 @@ cdef class Page:
             if ddjvu_document_decoding_error(self._document.ddjvu_document):
                 raise JobException_from_c(ddjvu_document_decoding_status(self._document.ddjvu_document))
             job = PageJob(sentinel = the_sentinel)
-            job._init(self._document._context, ddjvu_job)
+            job._init(context, ddjvu_job)
+            job._page = self
         finally:
-            release_lock(loft_lock)
+            release_lock(context._loft_lock)
         if wait:
             job.wait()
         return job
@@ -609,6 +830,49 @@ cdef class Thumbnail:
         '''
         return JobException_from_c(ddjvu_thumbnail_status(self._page._document.ddjvu_document, self._page._n, 1))
 
+    def wait(self):
+        '''
+        T.wait() -> None
+
+        Initiate the thumbnail calculating job, if needed, and wait until the
+        thumbnail is available.
+
+        Possible exceptions: JobFailed.
+        '''
+        cdef Document document
+        document = self._page._document
+        while True:
+            document._condition.acquire()
+            try:
+                ex = JobException_from_c(ddjvu_thumbnail_status(document.ddjvu_document, self._page._n, 1))
+                if ex is JobOK:
+                    return
+                elif ex is JobStarted or ex is JobNotStarted:
+                    document._condition.wait()
+                else:
+                    raise ex
+            finally:
+                document._condition.release()
+
+    def wait_async(self):
+        '''
+        T.wait_async() -> an asyncio future
+
+        Asynchronous counterpart of T.wait().
+        '''
+        cdef Document document
+        document = self._page._document
+        n = self._page._n
+        def check():
+            ex = JobException_from_c(ddjvu_thumbnail_status(document.ddjvu_document, n, 1))
+            if ex is JobOK:
+                return
+            elif ex is JobStarted or ex is JobNotStarted:
+                return the_sentinel
+            else:
+                raise ex
+        return watch(document._condition, document._watchers, check)
+
     def render(self, size, PixelFormat pixel_format not None, long row_alignment=1, dry_run=0, buffer=None):
         '''
         T.render((w0, h0), pixel_format, row_alignment=1, dry_run=False, buffer=None) -> ((w1, h1, row_size), data)
@@ -620,6 +884,9 @@ cdef class Thumbnail:
         * with each row starting at row_alignment bytes boundary;
         * into the provided buffer or to a newly created string.
 
+        If buffer is a BufferPool, the thumbnail is rendered into a
+        PooledBuffer taken from the pool.
+
         Raise NotAvailable when no thumbnail is available.
         Otherwise, return a ((w1, h1, row_size), data) tuple:
 
@@ -628,10 +895,16 @@ cdef class Thumbnail:
         * row_size is length of each image row, in bytes;
         * data is None if dry_run is true; otherwise is contains the
           actual image data.
+
+        The GIL is released while the thumbnail is being rendered, so
+        thumbnails can be rendered concurrently from multiple threads.
         '''
-        cdef int iw, ih
+        cdef int iw, ih, n
         cdef long w, h, row_size
         cdef void* memory
+        cdef ddjvu_document_t* ddjvu_document
+        cdef ddjvu_format_t* ddjvu_format
+        cdef int rc
         if row_alignment <= 0:
             raise ValueError('row_alignment must be a positive integer')
         w, h = size
@@ -646,7 +919,14 @@ cdef class Thumbnail:
             memory = NULL
         else:
             (result, memview) = allocate_image_memory(row_size, h, buffer, &memory)
-        if ddjvu_thumbnail_render(self._page._document.ddjvu_document, self._page._n, &iw, &ih, pixel_format.ddjvu_format, row_size, <char*> memory):
+        ddjvu_document = self._page._document.ddjvu_document
+        ddjvu_format = pixel_format.ddjvu_format
+        n = self._page._n
+        # The image memory is kept alive (and, for buffer-protocol objects,
+        # locked) by result and memview until the rendering is finished.
+        with nogil:
+            rc = ddjvu_thumbnail_render(ddjvu_document, n, &iw, &ih, ddjvu_format, row_size, <char*> memory)
+        if rc:
             return (iw, ih, row_size), result
         else:
             raise _NotAvailable_
@@ -657,6 +937,20 @@ cdef class Thumbnail:
             page=self._page,
         )
 
+class FileInfos(namedtuple('FileInfos', ['type', 'n_page', 'size', 'id', 'name', 'title'])):
+    '''
+    FileInfos(type, n_page, size, id, name, title) -> component file information
+
+    Information about all component files of a document.
+    See DocumentFiles.get_infos() for details.
+    '''
+    __slots__ = ()
+
+cdef object decode_utf8_or_none(const char* s):
+    if s == NULL:
+        return
+    return decode_utf8(s)
+
 cdef class DocumentFiles(DocumentExtension):
 
     '''
@@ -674,6 +968,109 @@ cdef class DocumentFiles(DocumentExtension):
         check_sentinel(self, kwargs)
         self._page_map = None
         self._document = document
+        self._infos = NULL
+        self._n_infos = 0
+        self._file_infos = None
+
+    cdef object _load_infos(self, int wait):
+        # Fetch information about all the component files in one pass, and
+        # index the files by page numbers.
+        cdef Document document = self._document
+        cdef ddjvu_fileinfo_t* infos
+        cdef ddjvu_status_t status
+        cdef int i, n
+        if self._infos != NULL:
+            return
+        if wait:
+            document.decoding_job.wait()
+        elif not ddjvu_document_decoding_done(document.ddjvu_document):
+            raise _NotAvailable_
+        if ddjvu_document_decoding_error(document.ddjvu_document):
+            raise JobException_from_c(ddjvu_document_decoding_status(document.ddjvu_document))
+        n = ddjvu_document_get_filenum(document.ddjvu_document)
+        infos = <ddjvu_fileinfo_t*> py_malloc(max(n, 1) * sizeof(ddjvu_fileinfo_t))
+        if infos == NULL:
+            raise MemoryError('Unable to allocate {0} bytes for file information'.format(max(n, 1) * sizeof(ddjvu_fileinfo_t)))
+        try:
+            i = 0
+            document._condition.acquire()
+            try:
+                while i < n:
+                    status = ddjvu_document_get_fileinfo(document.ddjvu_document, i, &infos[i])
+                    ex = JobException_from_c(status)
+                    if ex is JobOK:
+                        i += 1
+                    elif ex is JobStarted:
+                        if not wait:
+                            raise _NotAvailable_
+                        document._condition.wait()
+                    else:
+                        raise ex
+                page_map = {}
+                for i in range(n):
+                    if infos[i].pageno >= 0:
+                        page_map[infos[i].pageno] = i
+                if self._infos == NULL:
+                    self._page_map = page_map
+                    self._n_infos = n
+                    self._infos = infos
+                    infos = NULL
+            finally:
+                document._condition.release()
+        finally:
+            py_free(infos)
+
+    def get_infos(self, wait=1):
+        '''
+        F.get_infos(wait=True) -> a FileInfos named tuple
+
+        Return information about all component files of the document,
+        obtained in one pass. The fields of the named tuple are:
+
+        - type: a string with one character (FILE_TYPE_PAGE,
+          FILE_TYPE_THUMBNAILS or FILE_TYPE_INCLUDE) per file;
+        - n_page: an array.array('i') of page numbers, or -1 when not
+          applicable;
+        - size: an array.array('i') of file sizes, or -1 when unknown;
+        - id, name, title: tuples of strings or None.
+
+        The information is cached, and it's also used for looking up files by
+        pages: files[page].
+
+        If wait is true, wait until the information is available. Otherwise,
+        raise NotAvailable exception if it's not available yet.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        cdef ddjvu_fileinfo_t* info
+        cdef int i
+        if self._file_infos is not None:
+            return self._file_infos
+        self._load_infos(wait)
+        types = []
+        n_pages = array('i', [0]) * self._n_infos
+        sizes = array('i', [0]) * self._n_infos
+        ids = []
+        names = []
+        titles = []
+        for i in range(self._n_infos):
+            info = &self._infos[i]
+            types += [chr(info.type)]
+            n_pages[i] = info.pageno
+            sizes[i] = info.size
+            ids += [decode_utf8_or_none(info.id)]
+            names += [decode_utf8_or_none(info.name)]
+            titles += [decode_utf8_or_none(info.title)]
+        self._file_infos = FileInfos(''.join(types), n_pages, sizes, tuple(ids), tuple(names), tuple(titles))
+        return self._file_infos
+
+    cdef File get_file(self, int n):
+        cdef File file
+        file = File(self._document, n, sentinel = the_sentinel)
+        if n < self._n_infos:
+            file.ddjvu_fileinfo = self._infos[n]
+            file._have_info = 1
+        return file
 
     def __len__(self):
         cdef int result
@@ -687,24 +1084,22 @@ cdef class DocumentFiles(DocumentExtension):
         if is_int(key):
             if key < 0 or key >= len(self):
                 raise IndexError('file number out of range')
-            return File(self._document, key, sentinel = the_sentinel)
+            return self.get_file(key)
         elif typecheck(key, Page):
             if (<Page>key)._document is not self._document:
                 raise KeyError(key)
-            if self._page_map is None:
-                self._page_map = {}
-                for i in range(len(self)):
-                    file = File(self._document, i, sentinel = the_sentinel)
-                    n_page = file.n_page
-                    if n_page is not None:
-                        self._page_map[n_page] = file
+            self._load_infos(0)
             try:
-                return self._page_map[(<Page>key)._n]
+                i = self._page_map[(<Page>key)._n]
             except KeyError:
                 raise KeyError(key)
+            return self.get_file(i)
         else:
             raise TypeError('DocumentFiles indices must be integers or Page instances')
 
+    def __dealloc__(self):
+        py_free(self._infos)
+
 
 cdef class File:
 
@@ -741,6 +1136,7 @@ cdef class File:
         status = ddjvu_document_get_fileinfo(self._document.ddjvu_document, self._n, &self.ddjvu_fileinfo)
         ex = JobException_from_c(status)
         if ex is JobOK:
+            self._have_info = 1
             return
         elif ex is JobStarted:
             raise _NotAvailable_
@@ -917,6 +1313,87 @@ cdef object pages_to_opt(object pages, int sort_uniq):
         result = encode_utf8(result)
     return result
 
+cdef object parallel_imap
+def _parallel_imap(function, items, int workers, int ordered, int max_pending):
+    # Yield function(item) for each item, computing up to max_pending results
+    # in parallel threads.
+    cdef int i
+    cdef int n_running
+    cdef int next_index
+    items = enumerate(items)
+    items_lock = threading_Lock()
+    slots = Semaphore(max_pending)
+    results = Queue()
+    stopped = [False]
+    def work():
+        while True:
+            slots.acquire()
+            with items_lock:
+                try:
+                    if stopped[0]:
+                        raise StopIteration
+                    (index, item) = next(items)
+                except StopIteration:
+                    slots.release()
+                    results.put(the_sentinel)
+                    return
+                except Exception:
+                    results.put((None, None, sys.exc_info()))
+                    return
+            try:
+                result = function(item)
+            except Exception:
+                results.put((index, None, sys.exc_info()))
+            else:
+                results.put((index, result, None))
+    for i in range(workers):
+        thread = Thread(target=work)
+        thread.daemon = True
+        thread.start()
+    n_running = workers
+    next_index = 0
+    pending = {}
+    try:
+        while n_running > 0:
+            entry = results.get()
+            if entry is the_sentinel:
+                n_running -= 1
+                continue
+            (index, result, exc_info) = entry
+            if exc_info is not None:
+                IF PY3K:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                ELSE:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            if not ordered:
+                slots.release()
+                yield result
+                continue
+            pending[index] = result
+            while next_index in pending:
+                result = pending.pop(next_index)
+                next_index += 1
+                slots.release()
+                yield result
+    finally:
+        stopped[0] = True
+        for i in range(workers):
+            slots.release()
+parallel_imap = _parallel_imap
+del _parallel_imap
+
+cdef object get_parallel_workers(workers, max_pending):
+    if workers is None:
+        from multiprocessing import cpu_count
+        workers = cpu_count()
+    if workers <= 0:
+        raise ValueError('workers must be a positive integer')
+    if max_pending is None:
+        max_pending = 2 * workers
+    if max_pending < workers:
+        raise ValueError('max_pending must not be smaller than workers')
+    return (workers, max_pending)
+
 PRINT_ORIENTATION_AUTO = None
 PRINT_ORIENTATION_LANDSCAPE = 'landscape'
 PRINT_ORIENTATION_PORTRAIT = 'portrait'
@@ -948,14 +1425,29 @@ cdef class SaveJob(Job):
     def __cinit__(self, **kwargs):
         self._file = None
 
-    def wait(self):
-        Job.wait(self)
+    cdef object _finish(self):
         # Ensure that the underlying file is flushed.
         # FIXME: In Python 3, the file might be never flushed if you don't use wait()!
         if self._file is not None:
             (<_FileWrapper> self._file).close()
             self._file = None
 
+    def wait(self, timeout=None):
+        if not Job.wait(self, timeout):
+            return False
+        self._finish()
+        return True
+
+    def wait_async(self):
+        future = Job.wait_async(self)
+        def finish(future):
+            # If the future was cancelled, the job might be still writing to
+            # the file, so it must not be closed yet.
+            if not future.cancelled() and ddjvu_job_done(self.ddjvu_job):
+                self._finish()
+        future.add_done_callback(finish)
+        return future
+
 cdef class DocumentDecodingJob(Job):
 
     '''
@@ -968,6 +1460,7 @@ cdef class DocumentDecodingJob(Job):
         self._context = document._context
         self._document = document
         self._condition = document._condition
+        self._watchers = document._watchers
         self._queue = document._queue
         self.ddjvu_job = <ddjvu_job_t*> document.ddjvu_document
 
@@ -980,6 +1473,15 @@ cdef class DocumentDecodingJob(Job):
             doc=self._document,
         )
 
+class PageInfos(namedtuple('PageInfos', ['width', 'height', 'dpi', 'rotation', 'version'])):
+    '''
+    PageInfos(width, height, dpi, rotation, version) -> page information
+
+    Information about all pages of a document.
+    See Document.get_page_infos() for details.
+    '''
+    __slots__ = ()
+
 cdef class Document:
 
     '''
@@ -994,24 +1496,26 @@ cdef class Document:
         self._pages = DocumentPages(self, sentinel = the_sentinel)
         self._files = DocumentFiles(self, sentinel = the_sentinel)
         self._context = None
-        self._queue = Queue()
+        self._queue = _MessageQueue()
         self._condition = Condition()
+        self._watchers = []
 
     cdef object _init(self, Context context, ddjvu_document_t *ddjvu_document):
-        # Assumption: loft_lock is already acquired.
+        # Assumption: context._loft_lock is already acquired.
         assert (context is not None) and ddjvu_document != NULL
         self.ddjvu_document = ddjvu_document
         self._context = context
-        _document_loft.add(self)
-        _document_weak_loft[voidp_to_int(ddjvu_document)] = self
+        context._document_loft.add(self)
+        context._document_weak_loft[voidp_to_int(ddjvu_document)] = self
 
     cdef object _clear(self):
+        cdef Context context = self._context
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(context._loft_lock, WAIT_LOCK)
         try:
-            _document_loft.discard(self)
+            context._document_loft.discard(self)
         finally:
-            release_lock(loft_lock)
+            release_lock(context._loft_lock)
 
     property decoding_status:
         '''
@@ -1134,13 +1638,13 @@ cdef class Document:
             optv[optc] = s2
             optc = optc + 1
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(self._context._loft_lock, WAIT_LOCK)
         try:
             job = SaveJob(sentinel = the_sentinel)
             job._init(self._context, ddjvu_document_save(self.ddjvu_document, output, optc, optv))
             job._file = file_wrapper
         finally:
-            release_lock(loft_lock)
+            release_lock(self._context._loft_lock)
         if wait:
             job.wait()
         return job
@@ -1336,7 +1840,7 @@ cdef class Document:
                     options[optc] = option = encode_utf8(option)
                 optv[optc] = option
             with nogil:
-                acquire_lock(loft_lock, WAIT_LOCK)
+                acquire_lock(self._context._loft_lock, WAIT_LOCK)
             try:
                 job = SaveJob(sentinel = the_sentinel)
                 job._init(
@@ -1345,13 +1849,181 @@ cdef class Document:
                 )
                 job._file = file_wrapper
             finally:
-                release_lock(loft_lock)
+                release_lock(self._context._loft_lock)
         finally:
             py_free(optv)
         if wait:
             job.wait()
         return job
 
+    def render_pages(self, pages, mode, PixelFormat pixel_format not None, dpi=None, scale=None, long row_alignment=1, workers=None, ordered=1, max_pending=None):
+        '''
+        D.render_pages(pages, mode, pixel_format, dpi=None, scale=None, row_alignment=1, workers=<number-of-cpus>, ordered=True, max_pending=2*workers)
+          -> an iterator of (page_no, (w, h, row_size), data) tuples
+
+        Decode and render the specified pages (or all pages, if pages is None)
+        in workers parallel threads.
+
+        Each page is rendered as a whole:
+
+        * at the dpi resolution, or
+        * scaled by the scale factor, or
+        * in its natural size, if neither dpi nor scale is specified;
+
+        using the mode rendering mode and the pixel_format pixel format, with
+        each row starting at row_alignment bytes boundary.
+        See PageJob.render() for details.
+
+        If ordered is true, results are yielded in the order of pages.
+        Otherwise, they are yielded as soon as they are ready.
+
+        At most max_pending pages are decoded or waiting to be yielded
+        at any time.
+
+        If pages is None, wait until the document decoding is done, so that
+        the number of pages is known.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        if dpi is not None and scale is not None:
+            raise ValueError('dpi and scale cannot be both specified')
+        if dpi is not None and not dpi > 0:
+            raise ValueError('dpi must be a positive number')
+        if scale is not None and not scale > 0:
+            raise ValueError('scale must be a positive number')
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        (workers, max_pending) = get_parallel_workers(workers, max_pending)
+        if pages is None:
+            pages = self._get_all_pages()
+        def render_page(n):
+            cdef PageJob page_job
+            cdef long w, h
+            page_job = self._pages[n].decode(wait=True)
+            if page_job.is_error:
+                raise page_job.status
+            (w, h) = page_job.size
+            if dpi is not None:
+                factor = float(dpi) / page_job.dpi
+            else:
+                factor = scale
+            if factor is not None:
+                w = max(int(w * factor + 0.5), 1)
+                h = max(int(h * factor + 0.5), 1)
+            rect = (0, 0, w, h)
+            data = page_job.render(mode, rect, rect, pixel_format, row_alignment)
+            return (n, (w, h, calculate_row_size(w, row_alignment, pixel_format._bpp)), data)
+        return parallel_imap(render_page, pages, workers, ordered, max_pending)
+
+    cdef object _get_all_pages(self):
+        # len(self._pages) might return 1 before the document decoding is done.
+        self.decoding_job.wait()
+        if ddjvu_document_decoding_error(self.ddjvu_document):
+            raise JobException_from_c(ddjvu_document_decoding_status(self.ddjvu_document))
+        return range(len(self._pages))
+
+    def thumbnails(self, size, PixelFormat pixel_format not None, pages=None, long row_alignment=1, workers=None, ordered=1, max_pending=None):
+        '''
+        D.thumbnails((w0, h0), pixel_format, pages=None, row_alignment=1, workers=<number-of-cpus>, ordered=True, max_pending=2*workers)
+          -> an iterator of (page_no, (w1, h1, row_size), data) tuples
+
+        Calculate and render thumbnails of the specified pages (or all pages,
+        if pages is None) in workers parallel threads.
+
+        Each thumbnail is rendered as with Thumbnail.render((w0, h0),
+        pixel_format, row_alignment), as soon as it becomes available.
+
+        If ordered is true, results are yielded in the order of pages.
+        Otherwise, they are yielded as soon as they are ready.
+
+        At most max_pending thumbnails are calculated or waiting to be yielded
+        at any time.
+
+        If pages is None, wait until the document decoding is done, so that
+        the number of pages is known.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        cdef long w, h
+        w, h = size
+        if w <= 0 or h <= 0:
+            raise ValueError('size width/height must a positive integer')
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        (workers, max_pending) = get_parallel_workers(workers, max_pending)
+        if pages is None:
+            pages = self._get_all_pages()
+        def render_thumbnail(n):
+            cdef Thumbnail thumbnail
+            thumbnail = self._pages[n].thumbnail
+            thumbnail.wait()
+            (geometry, data) = thumbnail.render(size, pixel_format, row_alignment)
+            return (n, geometry, data)
+        return parallel_imap(render_thumbnail, pages, workers, ordered, max_pending)
+
+    def get_page_infos(self, wait=1):
+        '''
+        D.get_page_infos(wait=True) -> a PageInfos named tuple
+
+        Return information about all pages of the document, without decoding
+        the pages. Each field of the named tuple (width, height, dpi,
+        rotation, version) is an array.array('i') with one item per page, as
+        returned by the Page properties of the same names.
+
+        If wait is true, wait until the information is available for all the
+        pages. Otherwise, if the information is not available for some of the
+        pages, raise NotAvailable exception. Then, start fetching the page
+        data, which causes emission of PageInfoMessage messages with empty
+        .page_job.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        cdef ddjvu_pageinfo_t info
+        cdef ddjvu_status_t status
+        cdef int n, n_pages
+        if wait:
+            self.decoding_job.wait()
+        elif not ddjvu_document_decoding_done(self.ddjvu_document):
+            raise _NotAvailable_
+        if ddjvu_document_decoding_error(self.ddjvu_document):
+            raise JobException_from_c(ddjvu_document_decoding_status(self.ddjvu_document))
+        n_pages = ddjvu_document_get_pagenum(self.ddjvu_document)
+        widths = array('i', [0]) * n_pages
+        heights = array('i', [0]) * n_pages
+        dpis = array('i', [0]) * n_pages
+        rotations = array('i', [0]) * n_pages
+        versions = array('i', [0]) * n_pages
+        pending = range(n_pages)
+        while True:
+            self._condition.acquire()
+            try:
+                # Ask for all the pending pages at once, so that their data
+                # are fetched concurrently.
+                still_pending = []
+                for n in pending:
+                    if not self._pages.get_cached_info(n, &info):
+                        status = ddjvu_document_get_pageinfo(self.ddjvu_document, n, &info)
+                        ex = JobException_from_c(status)
+                        if ex is JobStarted:
+                            still_pending += [n]
+                            continue
+                        elif ex is not JobOK:
+                            raise ex
+                        self._pages.store_info(n, &info)
+                    widths[n] = info.width
+                    heights[n] = info.height
+                    dpis[n] = info.dpi
+                    rotations[n] = info.rotation * 90
+                    versions[n] = info.version
+                pending = still_pending
+                if not pending:
+                    return PageInfos(widths, heights, dpis, rotations, versions)
+                if not wait:
+                    raise _NotAvailable_
+                self._condition.wait()
+            finally:
+                self._condition.release()
+
     property message_queue:
         '''
         Return the internal message queue.
@@ -1371,23 +2043,43 @@ cdef class Document:
         except Empty:
             return
 
+    def get_message_async(self):
+        '''
+        D.get_message_async() -> an asyncio future
+
+        Get message from the internal document queue, as soon as one is
+        available.
+
+        Asynchronous iteration (async for) yields messages obtained this way.
+        Cancelling the future never loses a message.
+        '''
+        return watch_queue(self._condition, self._watchers, self._queue)
+
+    def __aiter__(self):
+        return _AsyncMessageIterator(self)
+
     def __iter__(self):
         return self
 
     def __next__(self):
         return self.get_message()
 
-cdef Document Document_from_c(ddjvu_document_t* ddjvu_document):
+cdef Document Document_from_c(Context context, ddjvu_document_t* ddjvu_document):
     cdef Document result
     if ddjvu_document == NULL:
-        result = None
-    else:
+        return None
+    key = voidp_to_int(ddjvu_document)
+    # Fast path: dictionary lookups are atomic under the GIL, so no lock is
+    # needed.
+    result = context._document_weak_loft.get(key)
+    if result is None:
+        # The document might be being registered right now.
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(context._loft_lock, WAIT_LOCK)
         try:
-            result = _document_weak_loft.get(voidp_to_int(ddjvu_document))
+            result = context._document_weak_loft.get(key)
         finally:
-            release_lock(loft_lock)
+            release_lock(context._loft_lock)
     return result
 
 
@@ -1398,19 +2090,122 @@ class FileUri(str):
 
 FileURI = FileUri
 
+class _MessageQueue(Queue):
+
+    # A message queue that keeps track of how many messages of each type it
+    # holds, so that C.set_queue_limit(...) can be enforced without scanning
+    # the queue.
+
+    def _init(self, maxsize):
+        self._messages = deque()
+        self._type_counts = {}
+
+    def _qsize(self):
+        return len(self._messages)
+
+    def _put(self, message):
+        self._messages.append(message)
+        tp = type(message)
+        self._type_counts[tp] = self._type_counts.get(tp, 0) + 1
+
+    def _get(self):
+        message = self._messages.popleft()
+        self._uncount(message)
+        return message
+
+    def _uncount(self, message):
+        tp = type(message)
+        n = self._type_counts[tp] - 1
+        if n:
+            self._type_counts[tp] = n
+        else:
+            del self._type_counts[tp]
+
+    def put_limited(self, message, is_limited, max_size, drop_oldest):
+        # Put the message, unless the queue already holds max_size messages
+        # of types for which is_limited(type) is true. In that case, drop
+        # either the oldest such message or the new one.
+        # Return the dropped message, or None.
+        dropped = None
+        with self.mutex:
+            count = 0
+            for (tp, n) in self._type_counts.items():
+                if is_limited(tp):
+                    count += n
+            if count >= max_size:
+                if not drop_oldest:
+                    return message
+                for dropped in self._messages:
+                    if is_limited(type(dropped)):
+                        break
+                self._messages.remove(dropped)
+                self._uncount(dropped)
+        self.put(message)
+        if dropped is not None:
+            # The dropped message will never be processed.
+            self.task_done()
+        return dropped
+
 cdef object Context_message_distributor
+cdef object notify_waiters(Context context, Job job, Document document):
+    # XXX Order of branches below is *crucial*. Do not change.
+    if job is not None:
+        job._condition.acquire()
+        try:
+            job._condition.notify_all()
+            run_watchers(job._watchers)
+        finally:
+            job._condition.release()
+        if job.is_done:
+            job._clear()
+    elif document is not None:
+        document._condition.acquire()
+        try:
+            document._condition.notify_all()
+            run_watchers(document._watchers)
+        finally:
+            document._condition.release()
+        if document.decoding_done:
+            document._clear()
+    else:
+        context._condition.acquire()
+        try:
+            run_watchers(context._watchers)
+        finally:
+            context._condition.release()
+
 def _Context_message_distributor(Context self not None, **kwargs):
     cdef Message message
-    cdef Document document
-    cdef Job job
-    cdef PageJob page_job
     cdef ddjvu_message_t* ddjvu_message
+    cdef ddjvu_job_t* skipped_job
+    cdef ddjvu_document_t* skipped_document
+    cdef int skipped
 
     check_sentinel(self, kwargs)
-    while True:
+    while not self._closed:
         with nogil:
             ddjvu_message = ddjvu_message_wait(self.ddjvu_context)
+            # Pop filtered messages without building Message objects.
+            # A run of filtered messages concerning the same job and document
+            # is coalesced into a single wakeup.
+            skipped = 0
+            skipped_job = NULL
+            skipped_document = NULL
+            while not self._closed and ddjvu_message != NULL and self._message_filter & (1U << ddjvu_message.m_any.tag):
+                if skipped and (ddjvu_message.m_any.job != skipped_job or ddjvu_message.m_any.document != skipped_document):
+                    break
+                skipped = 1
+                skipped_job = ddjvu_message.m_any.job
+                skipped_document = ddjvu_message.m_any.document
+                ddjvu_message_pop(self.ddjvu_context)
+                ddjvu_message = ddjvu_message_peek(self.ddjvu_context)
+        if self._closed:
+            # Context.close() woke us up.
+            return
         try:
+            if skipped:
+                notify_waiters(self, Job_from_c(self, skipped_job), Document_from_c(self, skipped_document))
+                continue
             try:
                 message = Message_from_c(ddjvu_message)
             finally:
@@ -1418,27 +2213,9 @@ def _Context_message_distributor(Context self not None, **kwargs):
             if message is None:
                 raise SystemError
             self.handle_message(message)
-            # XXX Order of branches below is *crucial*. Do not change.
-            if message._job is not None:
-                job = message._job
-                job._condition.acquire()
-                try:
-                    job._condition.notify_all()
-                finally:
-                    job._condition.release()
-                if job.is_done:
-                    job._clear()
-            elif message._page_job is not None:
+            if message._job is None and message._page_job is not None:
                 raise SystemError  # should not happen
-            elif message._document is not None:
-                document = message._document
-                document._condition.acquire()
-                try:
-                    document._condition.notify_all()
-                finally:
-                    document._condition.release()
-                if document.decoding_done:
-                    document._clear()
+            notify_waiters(self, message._job, message._document)
         except KeyboardInterrupt:
             return
         except SystemExit:
@@ -1455,6 +2232,13 @@ cdef class Context:
             argv0 = sys.argv[0]
         if is_unicode(argv0):
             argv0 = encode_utf8(argv0)
+        self._loft_lock = allocate_lock()
+        if self._loft_lock == NULL:
+            raise MemoryError('Unable to allocate lock')
+        self._document_loft = set()
+        self._document_weak_loft = weakref.WeakValueDictionary()
+        self._job_loft = set()
+        self._job_weak_loft = weakref.WeakValueDictionary()
         with nogil:
             acquire_lock(loft_lock, WAIT_LOCK)
         try:
@@ -1464,20 +2248,48 @@ cdef class Context:
             _context_loft[voidp_to_int(self.ddjvu_context)] = self
         finally:
             release_lock(loft_lock)
-        self._queue = Queue()
-        thread.start_new_thread(Context_message_distributor, (self,), {'sentinel': the_sentinel})
+        self._queue = _MessageQueue()
+        self._condition = Condition()
+        self._watchers = []
+        self._render_cache = None
+        self._queue_limits = {}
+        self._queue_limit_types = {}
+        self._dropped_messages = {}
+        self._message_filter = 0
+        self._closed = 0
+        self._thread = Thread(target=Context_message_distributor, args=(self,), kwargs={'sentinel': the_sentinel})
+        self._thread.daemon = True
+        self._thread.start()
+
+    cdef object _check_open(self):
+        if self._closed:
+            raise ValueError('operation on a closed context')
 
     property cache_size:
 
         def __set__(self, value):
+            self._check_open()
             if 0 < value < (1 << 31):
                 ddjvu_cache_set_size(self.ddjvu_context, value)
             else:
                 raise ValueError('0 < cache_size < (2 ** 31) must be satisfied')
 
         def __get__(self):
+            self._check_open()
             return ddjvu_cache_get_size(self.ddjvu_context)
 
+    property render_cache:
+        '''
+        The RenderCache used by PageJob.render(...) for pages of documents
+        created by this context, or None (the default) to disable caching of
+        rendered images.
+        '''
+        def __get__(self):
+            return self._render_cache
+
+        def __set__(self, RenderCache value):
+            self._render_cache = value
+
     def handle_message(self, Message message not None):
         '''
         C.handle_message(message) -> None
@@ -1494,6 +2306,9 @@ cdef class Context:
             else:
                 message.context.message_queue.put(message)
 
+        Messages are queued subject to the limits set with
+        C.set_queue_limit(...).
+
         You may want to override this method to change this behaviour.
 
         All exceptions raised by this method will be ignored.
@@ -1501,13 +2316,131 @@ cdef class Context:
 
         # XXX Order of branches below is *crucial*. Do not change.
         if message._job is not None:
-            message._job._queue.put(message)
+            queue = message._job._queue
         elif message._page_job is not None:
             raise SystemError  # should not happen
         elif message._document is not None:
-            message._document._queue.put(message)
+            queue = message._document._queue
+        else:
+            queue = message._context._queue
+        self._put_message(queue, message)
+
+    cdef object _get_queue_limit_type(self, message_type):
+        # Return the message type whose queue limit applies to message_type,
+        # or None.
+        cache = self._queue_limit_types
+        try:
+            return cache[message_type]
+        except KeyError:
+            pass
+        for tp in message_type.__mro__:
+            if tp in self._queue_limits:
+                break
+        else:
+            tp = None
+        cache[message_type] = tp
+        return tp
+
+    cdef object _put_message(self, object queue, Message message):
+        if not self._queue_limits:
+            queue.put(message)
+            return
+        tp = self._get_queue_limit_type(type(message))
+        if tp is None:
+            queue.put(message)
+            return
+        limit = self._queue_limits.get(tp)
+        if limit is None:
+            # The limit has been just removed.
+            queue.put(message)
+            return
+        (max_size, drop_oldest) = limit
+        if max_size == 0:
+            dropped = message
         else:
-            message._context._queue.put(message)
+            def is_limited(message_type):
+                return self._get_queue_limit_type(message_type) is tp
+            dropped = queue.put_limited(message, is_limited, max_size, drop_oldest)
+        if dropped is not None:
+            dropped_type = type(dropped)
+            self._dropped_messages[dropped_type] = self._dropped_messages.get(dropped_type, 0) + 1
+
+    def set_queue_limit(self, message_type, max_size=None, int drop_oldest=1):
+        '''
+        C.set_queue_limit(message_type, max_size=None, drop_oldest=True) -> None
+
+        Limit the number of messages of message_type (a Message subclass,
+        including its subclasses that don't have their own limit) that are
+        kept in each message queue by C.handle_message(...):
+
+        - if max_size is None, the number is not limited (this is the
+          default);
+        - if max_size is 0, such messages are dropped;
+        - otherwise, at most max_size such messages are kept in each queue;
+          when a new message arrives at a full queue, either the oldest such
+          message (if drop_oldest is true) or the new message is dropped.
+
+        In particular, max_size=1 keeps only the latest message.
+
+        Dropped messages are counted in C.dropped_messages.
+        '''
+        if not (isinstance(message_type, type) and issubclass(message_type, Message)):
+            raise TypeError('message_type must be a Message subclass')
+        if max_size is None:
+            self._queue_limits.pop(message_type, None)
+            self._queue_limit_types = {}
+            return
+        if max_size < 0:
+            raise ValueError('max_size must be a non-negative integer or None')
+        self._queue_limits[message_type] = (max_size, drop_oldest)
+        self._queue_limit_types = {}
+
+    def set_message_filter(self, message_types=None):
+        '''
+        C.set_message_filter(message_types=None) -> None
+
+        Skip messages of the specified message_types (Message subclasses,
+        including their subclasses), or none of them if message_types is
+        None.
+
+        Skipped messages are discarded before Message objects are created, and
+        they are not passed to C.handle_message(...). Blocking methods (such
+        as Job.wait()) are still woken up by them.
+
+        Note that skipping NewStreamMessage messages makes it impossible to
+        provide data of documents that are not local files.
+        '''
+        cdef unsigned int message_filter
+        message_filter = 0
+        if message_types is not None:
+            message_types = tuple(message_types)
+            for message_type in message_types:
+                if not (isinstance(message_type, type) and issubclass(message_type, Message)):
+                    raise TypeError('message_types must be Message subclasses')
+            for (tag, message_type) in MESSAGE_MAP.items():
+                if issubclass(message_type, message_types):
+                    message_filter |= 1U << tag
+        self._message_filter = message_filter
+
+    property message_filter:
+        '''
+        Return the set of message types that are skipped, see
+        C.set_message_filter(...).
+        '''
+        def __get__(self):
+            return frozenset(
+                message_type
+                for (tag, message_type) in MESSAGE_MAP.items()
+                if self._message_filter & (1U << tag)
+            )
+
+    property dropped_messages:
+        '''
+        Return a dictionary mapping message types to the numbers of messages
+        of these types that were dropped because of C.set_queue_limit(...).
+        '''
+        def __get__(self):
+            return dict(self._dropped_messages)
 
     property message_queue:
         '''
@@ -1528,6 +2461,21 @@ cdef class Context:
         except Empty:
             return
 
+    def get_message_async(self):
+        '''
+        C.get_message_async() -> an asyncio future
+
+        Get message from the internal context queue, as soon as one is
+        available.
+
+        Asynchronous iteration (async for) yields messages obtained this way.
+        Cancelling the future never loses a message.
+        '''
+        return watch_queue(self._condition, self._watchers, self._queue)
+
+    def __aiter__(self):
+        return _AsyncMessageIterator(self)
+
     def new_document(self, uri, cache=1):
         '''
         C.new_document(uri, cache=True) -> a Document
@@ -1559,8 +2507,9 @@ cdef class Context:
         '''
         cdef Document document
         cdef ddjvu_document_t* ddjvu_document
+        self._check_open()
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(self._loft_lock, WAIT_LOCK)
         try:
             if typecheck(uri, FileUri):
                 IF PY3K:
@@ -1575,7 +2524,7 @@ cdef class Context:
             document = Document(sentinel = the_sentinel)
             document._init(self, ddjvu_document)
         finally:
-            release_lock(loft_lock)
+            release_lock(self._loft_lock)
         return document
 
     def __iter__(self):
@@ -1588,9 +2537,74 @@ cdef class Context:
         '''
         C.clear_cache() -> None
         '''
+        self._check_open()
         ddjvu_cache_clear(self.ddjvu_context)
 
-    def __dealloc__(self):
+    def close(self):
+        '''
+        C.close() -> None
+
+        Stop and join the message distributor thread, stop unfinished jobs
+        of the context, release the documents and jobs that the context kept
+        alive, and release the native context.
+
+        Messages are no longer delivered afterwards, so blocking methods of
+        the remaining documents and jobs must not be used.
+
+        Calling this method more than once has no effect.
+        '''
+        cdef ddjvu_document_t* ddjvu_document
+        cdef Document document
+        cdef Job job
+        if self._closed:
+            return
+        self._closed = 1
+        # The message distributor is most likely blocked in
+        # ddjvu_message_wait(). The DjVuLibre API offers no way to interrupt
+        # it, other than posting a message to the context, and there is no
+        # function for posting arbitrary messages either. So create a dummy
+        # document: for a URI that is not a local file, ddjvu_document_create()
+        # posts a NewStreamMessage right away, without any I/O or decoding.
+        # The distributor checks self._closed after every wakeup, so it exits
+        # without handling this message.
+        ddjvu_document = ddjvu_document_create(self.ddjvu_context, "dummy://close.djvu", 0)
+        try:
+            if self._thread is not current_thread():
+                self._thread.join()
+        finally:
+            if ddjvu_document != NULL:
+                ddjvu_document_release(ddjvu_document)
+        with nogil:
+            acquire_lock(self._loft_lock, WAIT_LOCK)
+        try:
+            for document in self._document_loft:
+                ddjvu_job_stop(<ddjvu_job_t*> document.ddjvu_document)
+            self._document_loft.clear()
+            for job in self._job_loft:
+                ddjvu_job_stop(job.ddjvu_job)
+            self._job_loft.clear()
+        finally:
+            release_lock(self._loft_lock)
+        with nogil:
+            acquire_lock(loft_lock, WAIT_LOCK)
+        try:
+            del _context_loft[voidp_to_int(self.ddjvu_context)]
+        finally:
+            release_lock(loft_lock)
+        ddjvu_context_release(self.ddjvu_context)
+        self.ddjvu_context = NULL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __dealloc__(self):
+        if self._loft_lock != NULL:
+            free_lock(self._loft_lock)
+        if self.ddjvu_context == NULL:
+            return
         ddjvu_context_release(self.ddjvu_context)
 
 cdef Context Context_from_c(ddjvu_context_t* ddjvu_context):
@@ -1598,17 +2612,130 @@ cdef Context Context_from_c(ddjvu_context_t* ddjvu_context):
     if ddjvu_context == NULL:
         result = None
     else:
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+        # No lock is needed: a context is registered before its message
+        # distributor starts, and dictionary lookups are atomic under the GIL.
         try:
-            try:
-                result = _context_loft[voidp_to_int(ddjvu_context)]
-            except KeyError:
-                raise SystemError
-        finally:
-            release_lock(loft_lock)
+            result = _context_loft[voidp_to_int(ddjvu_context)]
+        except KeyError:
+            raise SystemError
     return result
 
+cdef class ContextPool:
+
+    '''
+    ContextPool(n, argv0=None, context_class=Context) -> a pool of contexts
+
+    A pool of n contexts (instances of context_class), each with its own
+    message distributor thread. New documents are spread over the contexts,
+    so that messages of many concurrent documents are dispatched by several
+    threads.
+    '''
+
+    def __cinit__(self, int n, argv0=None, context_class=Context):
+        if n <= 0:
+            raise ValueError('n must be a positive integer')
+        if not (isinstance(context_class, type) and issubclass(context_class, Context)):
+            raise TypeError('context_class must be a Context subclass')
+        self._contexts = tuple(context_class(argv0) for i in range(n))
+        self._documents = tuple(weakref.WeakSet() for i in range(n))
+
+    property contexts:
+        '''
+        Return the contexts of the pool.
+        '''
+        def __get__(self):
+            return self._contexts
+
+    def __len__(self):
+        return len(self._contexts)
+
+    cdef int _choose(self, key) except -1:
+        cdef int i, best
+        if key is not None:
+            return hash(key) % len(self._contexts)
+        best = 0
+        for i in range(1, len(self._contexts)):
+            if len(self._documents[i]) < len(self._documents[best]):
+                best = i
+        return best
+
+    def new_document(self, uri, cache=1, key=None):
+        '''
+        P.new_document(uri, cache=True, key=None) -> a Document
+
+        Create a document in one of the contexts, see Context.new_document().
+
+        If key is not None, documents with equal keys are created in the same
+        context, so that they share its cache of decoded pages. Otherwise,
+        the context with the fewest live documents is used.
+        '''
+        cdef int i
+        i = self._choose(key)
+        document = self._contexts[i].new_document(uri, cache)
+        self._documents[i].add(document)
+        return document
+
+    property cache_size:
+        '''
+        The total cache size of the contexts. Setting it splits the size
+        evenly among them.
+        '''
+        def __get__(self):
+            return sum(context.cache_size for context in self._contexts)
+
+        def __set__(self, value):
+            n = len(self._contexts)
+            if not 0 < value // n < (1 << 31):
+                raise ValueError('0 < cache_size / n < (2 ** 31) must be satisfied')
+            for context in self._contexts:
+                context.cache_size = value // n
+
+    def get_stats(self):
+        '''
+        P.get_stats() -> a list of dictionaries
+
+        Return statistics of every context of the pool, with the following
+        keys:
+
+        - 'documents': the number of live documents created with
+          P.new_document(...);
+        - 'cache_size': the cache size;
+        - 'dropped_messages': the number of messages dropped because of
+          Context.set_queue_limit(...).
+        '''
+        return [
+            dict(
+                documents=len(documents),
+                cache_size=context.cache_size,
+                dropped_messages=sum(context.dropped_messages.values()),
+            )
+            for (context, documents) in izip(self._contexts, self._documents)
+        ]
+
+    def clear_cache(self):
+        '''
+        P.clear_cache() -> None
+
+        Clear caches of all the contexts.
+        '''
+        for context in self._contexts:
+            context.clear_cache()
+
+    def close(self):
+        '''
+        P.close() -> None
+
+        Close all the contexts, see Context.close().
+        '''
+        for context in self._contexts:
+            context.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 RENDER_COLOR = DDJVU_RENDER_COLOR
 RENDER_BLACK = DDJVU_RENDER_BLACK
 RENDER_COLOR_ONLY = DDJVU_RENDER_COLORONLY
@@ -1616,6 +2743,13 @@ RENDER_MASK_ONLY = DDJVU_RENDER_MASKONLY
 RENDER_BACKGROUND = DDJVU_RENDER_BACKGROUND
 RENDER_FOREGROUND = DDJVU_RENDER_FOREGROUND
 
+# A pseudo render mode, which is implemented on top of
+# DDJVU_RENDER_FOREGROUND and DDJVU_RENDER_MASKONLY:
+cdef enum:
+    FOREGROUND_ALPHA_MODE = 0x100
+
+RENDER_FOREGROUND_ALPHA = FOREGROUND_ALPHA_MODE
+
 PAGE_TYPE_UNKNOWN = DDJVU_PAGETYPE_UNKNOWN
 PAGE_TYPE_BITONAL = DDJVU_PAGETYPE_BITONAL
 PAGE_TYPE_PHOTO = DDJVU_PAGETYPE_PHOTO
@@ -1653,7 +2787,8 @@ cdef class PixelFormat:
             return bool(self._row_order)
 
         def __set__(self, value):
-            ddjvu_format_set_row_order(self.ddjvu_format, not not value)
+            self._row_order = not not value
+            ddjvu_format_set_row_order(self.ddjvu_format, self._row_order)
 
     property y_top_to_bottom:
         '''
@@ -1665,10 +2800,11 @@ cdef class PixelFormat:
         '''
 
         def __get__(self):
-            return bool(self._row_order)
+            return bool(self._y_direction)
 
         def __set__(self, value):
-            ddjvu_format_set_y_direction(self.ddjvu_format, not not value)
+            self._y_direction = not not value
+            ddjvu_format_set_y_direction(self.ddjvu_format, self._y_direction)
 
     property bpp:
         '''
@@ -1708,6 +2844,7 @@ cdef class PixelFormat:
         def __set__(self, double value):
             if (0.5 <= value <= 5.0):
                 ddjvu_format_set_gamma(self.ddjvu_format, value)
+                self._gamma = value
             else:
                 raise ValueError('0.5 <= value <= 5.0 must be satisfied')
 
@@ -1861,6 +2998,9 @@ cdef class PixelFormatPalette(PixelFormat):
             raise ValueError('bpp must be equal to 8')
         self._bpp = self._dither_bpp = bpp
         self.ddjvu_format = ddjvu_format_create(DDJVU_FORMAT_PALETTE8, 216, self._palette)
+        # The palette is immutable; keep it as a hashable object for the
+        # render cache.
+        self._key = charp_to_bytes(<char*> self._palette, sizeof(self._palette))
 
     def __repr__(self):
         cdef int i, j, k
@@ -1918,6 +3058,387 @@ cdef class PixelFormatPackedBits(PixelFormat):
             end=self.endianness,
         )
 
+cdef class _ImageMemory:
+
+    def __cinit__(self, Py_ssize_t size):
+        self.memory = <char*> py_malloc(size)
+        if self.memory == NULL:
+            raise MemoryError('Unable to allocate {0} bytes for an image memory'.format(size))
+        self.size = size
+
+    def __dealloc__(self):
+        py_free(self.memory)
+
+cdef class BufferPool:
+
+    '''
+    BufferPool(max_size=None) -> a buffer pool
+
+    A pool of image buffers, which can be passed as the buffer argument to
+    the rendering methods, such as PageJob.render(...) and
+    Thumbnail.render(...). The image is then rendered into a PooledBuffer
+    taken from the pool. When the PooledBuffer is no longer referenced, its
+    memory is given back to the pool, so that it can be reused for the
+    subsequent images of the same size.
+
+    max_size is the maximum total size (in bytes) of the unused memory kept
+    by the pool; None means no limit.
+    '''
+
+    def __cinit__(self, max_size=None):
+        self._chunks = {}
+        self._size = 0
+        # The lock must be reentrant: deallocation of other buffers (e.g. by
+        # the garbage collector) may put memory back while it's held.
+        self._lock = RLock()
+        if max_size is None:
+            self._max_size = -1
+        else:
+            if max_size < 0:
+                raise ValueError('max_size must be a non-negative integer or None')
+            self._max_size = max_size
+
+    property max_size:
+        '''
+        Return the maximum total size (in bytes) of the unused memory kept by
+        the pool, or None if there is no limit.
+        '''
+        def __get__(self):
+            if self._max_size < 0:
+                return
+            return self._max_size
+
+    property size:
+        '''
+        Return the total size (in bytes) of the unused memory kept by the
+        pool.
+        '''
+        def __get__(self):
+            return self._size
+
+    cdef PooledBuffer get_buffer(self, Py_ssize_t size):
+        cdef PooledBuffer buffer
+        cdef _ImageMemory chunk = None
+        with self._lock:
+            chunks = self._chunks.get(size)
+            if chunks:
+                chunk = chunks.pop()
+                self._size -= size
+        if chunk is None:
+            chunk = _ImageMemory(size)
+        buffer = PooledBuffer(sentinel=the_sentinel)
+        buffer._pool = self
+        buffer._chunk = chunk
+        return buffer
+
+    cdef object put_memory(self, _ImageMemory chunk):
+        with self._lock:
+            if self._max_size >= 0 and self._size + chunk.size > self._max_size:
+                return
+            self._size += chunk.size
+            try:
+                chunks = self._chunks[chunk.size]
+            except KeyError:
+                chunks = self._chunks[chunk.size] = []
+            chunks += [chunk]
+
+    def get(self, Py_ssize_t size):
+        '''
+        P.get(size) -> a PooledBuffer
+
+        Take a buffer of the specified size from the pool, or create a new one
+        if there is no unused buffer of that size.
+
+        Contents of the buffer are undefined.
+        '''
+        if size < 0:
+            raise ValueError('size must be a non-negative integer')
+        return self.get_buffer(size)
+
+    def clear(self):
+        '''
+        P.clear() -> None
+
+        Free all the unused memory kept by the pool.
+        '''
+        with self._lock:
+            self._chunks = {}
+            self._size = 0
+
+cdef class PooledBuffer:
+
+    '''
+    A writable image buffer taken from a BufferPool.
+
+    Use BufferPool.get(...) or pass a BufferPool to a rendering method to
+    obtain instances of this class. The buffer supports the buffer protocol.
+    '''
+
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+
+    property pool:
+        '''
+        Return the pool the buffer belongs to.
+        '''
+        def __get__(self):
+            return self._pool
+
+    def __len__(self):
+        return self._chunk.size
+
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        PyBuffer_FillInfo(view, self, self._chunk.memory, self._chunk.size, 0, flags)
+
+    def __dealloc__(self):
+        if self._pool is None or self._chunk is None:
+            return
+        self._pool.put_memory(self._chunk)
+
+cdef class RenderCache:
+
+    '''
+    RenderCache(max_size) -> a render cache
+
+    A cache of rendered images. Assign it to Context.render_cache to make
+    PageJob.render(...) reuse the images that have been already rendered
+    with the same document, page, page rotation, mode, page_rect,
+    render_rect, pixel_format and row_alignment.
+
+    Only images of fully decoded pages are cached. Only PageJob.render(...)
+    uses the cache; the other rendering methods (such as
+    PageJob.render_tiles(...) or PageJob.save_image(...)) don't.
+
+    max_size is the maximum total size (in bytes) of the cached images. When
+    it is exceeded, the least recently used images are evicted.
+
+    The cache keeps references to documents of the cached images.
+    '''
+
+    def __cinit__(self, max_size):
+        if max_size < 0:
+            raise ValueError('max_size must be a non-negative integer')
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = self._misses = self._evictions = 0
+        self._lock = RLock()
+
+    property max_size:
+        '''
+        Return the maximum total size (in bytes) of the cached images.
+        '''
+        def __get__(self):
+            return self._max_size
+
+    property size:
+        '''
+        Return the total size (in bytes) of the cached images.
+        '''
+        def __get__(self):
+            return self._size
+
+    property hits:
+        '''
+        Return the number of images that were found in the cache.
+        '''
+        def __get__(self):
+            return self._hits
+
+    property misses:
+        '''
+        Return the number of images that were not found in the cache.
+        '''
+        def __get__(self):
+            return self._misses
+
+    property evictions:
+        '''
+        Return the number of images that were evicted from the cache to keep
+        its size within max_size.
+        '''
+        def __get__(self):
+            return self._evictions
+
+    def __len__(self):
+        return len(self._entries)
+
+    cdef object lookup(self, object key):
+        with self._lock:
+            try:
+                data = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return
+            self._entries[key] = data
+            self._hits += 1
+            return data
+
+    cdef object store(self, object key, object data):
+        cdef Py_ssize_t size
+        size = len(data)
+        if size > self._max_size:
+            return
+        with self._lock:
+            old_data = self._entries.pop(key, None)
+            if old_data is not None:
+                self._size -= len(old_data)
+            self._entries[key] = data
+            self._size += size
+            while self._size > self._max_size:
+                (key, data) = self._entries.popitem(last=False)
+                self._size -= len(data)
+                self._evictions += 1
+
+    def invalidate(self, target=None):
+        '''
+        R.invalidate(target=None) -> None
+
+        Remove cached images:
+
+        - of all pages of target, if it is a Document;
+        - of the target page, if it is a Page;
+        - all of them, if target is None.
+        '''
+        cdef Page page
+        if target is not None and not typecheck(target, Document) and not typecheck(target, Page):
+            raise TypeError('target must be a Document, a Page or None')
+        with self._lock:
+            if target is None:
+                self._entries = OrderedDict()
+                self._size = 0
+                return
+            if typecheck(target, Document):
+                keys = [key for key in self._entries if key[0] is target]
+            else:
+                page = target
+                keys = [key for key in self._entries if key[0] is page._document and key[1] == page._n]
+            for key in keys:
+                self._size -= len(self._entries.pop(key))
+
+cdef object get_pixel_format_key(PixelFormat pixel_format):
+    cdef unsigned int *params
+    if typecheck(pixel_format, PixelFormatRgb):
+        fields = (<PixelFormatRgb> pixel_format)._rgb
+    elif typecheck(pixel_format, PixelFormatRgbMask):
+        params = (<PixelFormatRgbMask> pixel_format)._params
+        fields = (params[0], params[1], params[2], params[3])
+    elif typecheck(pixel_format, PixelFormatPalette):
+        fields = (<PixelFormatPalette> pixel_format)._key
+    elif typecheck(pixel_format, PixelFormatPackedBits):
+        fields = (<PixelFormatPackedBits> pixel_format)._little_endian
+    else:
+        fields = None
+    return (
+        type(pixel_format), fields, pixel_format._bpp,
+        pixel_format._row_order, pixel_format._y_direction,
+        pixel_format._dither_bpp, pixel_format._gamma,
+    )
+
+cdef class ImageBuffer:
+
+    '''
+    A rendered image, which supports the buffer protocol.
+
+    Use PageJob.render_image(...) to obtain instances of this class.
+
+    Rows are exposed from the top to the bottom of the image, regardless of
+    how they are stored in memory.
+    '''
+
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+        self._data = None
+        self._buf = NULL
+        self._format = NULL
+
+    property shape:
+        '''
+        Return the shape of the image:
+
+        - (height, width, 3) for the RGB pixel format;
+        - (height, width) for the other pixel formats.
+        '''
+        def __get__(self):
+            return tuple([self._shape[i] for i in range(self._ndim)])
+
+    property strides:
+        '''
+        Return the strides of the image, in bytes.
+        '''
+        def __get__(self):
+            return tuple([self._strides[i] for i in range(self._ndim)])
+
+    property format:
+        '''
+        Return the struct module format of a single item of the image:
+
+        - 'B' for the RGB, grey and palette pixel formats;
+        - 'H' for the 16-bit RGB mask pixel format;
+        - 'I' for the 32-bit RGB mask pixel format.
+        '''
+        def __get__(self):
+            return charp_to_string(<char*> self._format)
+
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        cdef int i
+        if (flags & PyBUF_STRIDES) != PyBUF_STRIDES and not self._contiguous:
+            raise BufferError('image is not C-contiguous')
+        view.buf = self._buf
+        view.obj = self
+        view.len = self._itemsize
+        for i in range(self._ndim):
+            view.len *= self._shape[i]
+        view.readonly = 0
+        view.itemsize = self._itemsize
+        view.format = NULL
+        if flags & PyBUF_FORMAT:
+            view.format = <char*> self._format
+        view.ndim = 1
+        view.shape = NULL
+        if (flags & PyBUF_ND) == PyBUF_ND:
+            view.ndim = self._ndim
+            view.shape = self._shape
+        view.strides = NULL
+        if (flags & PyBUF_STRIDES) == PyBUF_STRIDES:
+            view.strides = self._strides
+        view.suboffsets = NULL
+        view.internal = NULL
+
+cdef ImageBuffer ImageBuffer_from_data(PooledBuffer data, long width, long height, long row_size, PixelFormat pixel_format):
+    cdef ImageBuffer image
+    cdef Py_ssize_t pixel_size
+    image = ImageBuffer(sentinel=the_sentinel)
+    pixel_size = pixel_format._bpp >> 3
+    if typecheck(pixel_format, PixelFormatRgb):
+        image._format = 'B'
+        image._itemsize = 1
+        image._ndim = 3
+        image._shape[2] = 3
+        image._strides[2] = 1
+    elif typecheck(pixel_format, PixelFormatRgbMask):
+        image._format = 'H' if pixel_size == 2 else 'I'
+        image._itemsize = pixel_size
+        image._ndim = 2
+    elif typecheck(pixel_format, PixelFormatGrey) or typecheck(pixel_format, PixelFormatPalette):
+        image._format = 'B'
+        image._itemsize = 1
+        image._ndim = 2
+    else:
+        raise ValueError('pixel_format cannot be represented as an image buffer')
+    image._shape[0] = height
+    image._shape[1] = width
+    image._strides[1] = pixel_size
+    image._data = data
+    if pixel_format._row_order:
+        image._buf = data._chunk.memory
+        image._strides[0] = row_size
+    else:
+        image._buf = data._chunk.memory + (height - 1) * row_size
+        image._strides[0] = -row_size
+    image._contiguous = image._strides[0] == width * pixel_size
+    return image
+
 cdef object calculate_row_size(long width, long row_alignment, int bpp):
     cdef long result
     cdef object row_size
@@ -1931,6 +3452,85 @@ cdef object calculate_row_size(long width, long row_alignment, int bpp):
     result = ((row_size + (row_alignment - 1)) // row_alignment) * row_alignment
     return result
 
+cdef object get_pnm_header(PixelFormat pixel_format):
+    if typecheck(pixel_format, PixelFormatRgb) and (<PixelFormatRgb> pixel_format)._rgb:
+        return ('ppm', 'P6\n{w} {h}\n255\n')
+    elif typecheck(pixel_format, PixelFormatGrey):
+        return ('pgm', 'P5\n{w} {h}\n255\n')
+    elif typecheck(pixel_format, PixelFormatPackedBits) and not (<PixelFormatPackedBits> pixel_format)._little_endian:
+        return ('pbm', 'P4\n{w} {h}\n')
+    raise ValueError('pixel_format cannot be saved as a PNM image')
+
+cdef object write_pnm(object path, object header, long width, long height, PixelFormat pixel_format, long row_size, object data):
+    cdef long i, j
+    cdef long line_size
+    line_size = calculate_row_size(width, 1, pixel_format._bpp)
+    with open(path, 'wb') as file:
+        file.write(header.format(w=width, h=height).encode('ASCII'))
+        if line_size == row_size and pixel_format._row_order:
+            file.write(data)
+            return
+        for i in range(height):
+            if pixel_format._row_order:
+                j = i
+            else:
+                j = height - 1 - i
+            file.write(data[j * row_size:j * row_size + line_size])
+
+cdef object get_pnm_pixel_format(object format, PixelFormat pixel_format):
+    # Return the pixel format (possibly the default one) for the PNM format,
+    # and the header template.
+    if format not in ('ppm', 'pgm', 'pbm'):
+        raise ValueError("format must be equal to 'ppm', 'pgm' or 'pbm'")
+    if pixel_format is None:
+        if format == 'ppm':
+            pixel_format = PixelFormatRgb()
+        elif format == 'pgm':
+            pixel_format = PixelFormatGrey()
+        else:
+            pixel_format = PixelFormatPackedBits('>')
+        pixel_format.rows_top_to_bottom = True
+    (extension, header) = get_pnm_header(pixel_format)
+    if extension != format:
+        raise ValueError('pixel_format cannot be saved as a {0} image'.format(format.upper()))
+    return (pixel_format, header)
+
+cdef object get_png_format(PixelFormat pixel_format, int mode):
+    # Return (bit depth, color type, whether to invert bits, whether to make
+    # the alpha channel opaque).
+    cdef unsigned int *params
+    if typecheck(pixel_format, PixelFormatRgb) and (<PixelFormatRgb> pixel_format)._rgb:
+        return (8, 2, False, False)
+    elif typecheck(pixel_format, PixelFormatGrey):
+        return (8, 0, False, False)
+    elif typecheck(pixel_format, PixelFormatPackedBits) and not (<PixelFormatPackedBits> pixel_format)._little_endian:
+        # In PNG, 0 stands for black:
+        return (1, 0, True, False)
+    elif typecheck(pixel_format, PixelFormatRgbMask) and pixel_format._bpp == 32:
+        params = (<PixelFormatRgbMask> pixel_format)._params
+        if (params[0], params[1], params[2]) == get_rgba_masks()[:3]:
+            # Only RENDER_FOREGROUND_ALPHA fills the alpha channel;
+            # otherwise, its contents are undefined.
+            return (8, 6, False, mode != FOREGROUND_ALPHA_MODE)
+    raise ValueError('pixel_format cannot be saved as a PNG image')
+
+cdef object get_rgba_masks():
+    # Return masks of the red, green, blue and alpha channels for a 32-bit
+    # pixel format, which has the RGBA byte order in memory.
+    if sys.byteorder == 'little':
+        return (0xFF, 0xFF00, 0xFF0000, 0xFF000000)
+    else:
+        return (0xFF000000, 0xFF0000, 0xFF00, 0xFF)
+
+cdef object write_png_chunk(object file, object tag, object data):
+    file.write(struct_pack('>I', len(data)))
+    file.write(tag)
+    file.write(data)
+    file.write(struct_pack('>I', crc32(data, crc32(tag)) & 0xFFFFFFFF))
+
+cdef object PNG_INVERT_TABLE
+PNG_INVERT_TABLE = bytes(bytearray(range(0xFF, -1, -1)))
+
 cdef object allocate_image_memory(long width, long height, object buffer, void **memory):
     cdef char[::1] memview = None
     cdef Py_ssize_t c_requested_size
@@ -1943,6 +3543,9 @@ cdef object allocate_image_memory(long width, long height, object buffer, void *
     if buffer is None:
         result = charp_to_bytes(NULL, c_requested_size)
         memory[0] = <char*> result
+    elif typecheck(buffer, BufferPool):
+        result = (<BufferPool> buffer).get_buffer(c_requested_size)
+        memory[0] = (<PooledBuffer> result)._chunk.memory
     else:
         result = buffer
         IF PY3K:
@@ -1956,6 +3559,171 @@ cdef object allocate_image_memory(long width, long height, object buffer, void *
                 raise ValueError('Image buffer is too small ({0} > {1})'.format(c_requested_size, c_memory_size))
     return (result, memview)
 
+cdef unsigned int get_alpha_mask(PixelFormat pixel_format) except 0:
+    cdef unsigned int *params
+    cdef unsigned int alpha_mask
+    if not typecheck(pixel_format, PixelFormatRgbMask) or pixel_format._bpp != 32:
+        raise ValueError('RENDER_FOREGROUND_ALPHA requires a 32-bit PixelFormatRgbMask')
+    params = (<PixelFormatRgbMask> pixel_format)._params
+    alpha_mask = ~(params[0] | params[1] | params[2]) & 0xFFFFFFFF
+    if alpha_mask == 0:
+        raise ValueError('pixel_format has no bits left for the alpha channel')
+    while not alpha_mask & 1:
+        alpha_mask >>= 1
+    if alpha_mask & (alpha_mask + 1):
+        raise ValueError('alpha channel bits of pixel_format must be contiguous')
+    return ~(params[0] | params[1] | params[2]) & 0xFFFFFFFF
+
+cdef int render_page(ddjvu_page_t *ddjvu_page, int mode, ddjvu_rect_t *page_rect, ddjvu_rect_t *render_rect, PixelFormat pixel_format, unsigned long row_size, char *memory) except -1:
+    cdef ddjvu_format_t *ddjvu_format
+    cdef ddjvu_format_t *mask_format
+    cdef unsigned char *mask
+    cdef unsigned char *mask_row
+    cdef char *row
+    cdef unsigned int alpha_mask, alpha_max, alpha_shift, pixel
+    cdef unsigned int x, y
+    cdef int rc
+    ddjvu_format = pixel_format.ddjvu_format
+    if mode != FOREGROUND_ALPHA_MODE:
+        with nogil:
+            rc = ddjvu_page_render(ddjvu_page, <ddjvu_render_mode_t> mode, page_rect, render_rect, ddjvu_format, row_size, memory)
+        return rc
+    alpha_mask = get_alpha_mask(pixel_format)
+    alpha_shift = 0
+    while not (alpha_mask >> alpha_shift) & 1:
+        alpha_shift += 1
+    alpha_max = alpha_mask >> alpha_shift
+    # The stencil is rendered into a separate grey image, with the same row
+    # order and y direction, and then merged into the alpha channel.
+    mask = <unsigned char*> py_malloc(<size_t> render_rect.w * render_rect.h)
+    if mask == NULL:
+        raise MemoryError('Unable to allocate {0} bytes for an image memory'.format(int(render_rect.w) * render_rect.h))
+    mask_format = ddjvu_format_create(DDJVU_FORMAT_GREY8, 0, NULL)
+    try:
+        if mask_format == NULL:
+            raise MemoryError
+        ddjvu_format_set_row_order(mask_format, pixel_format._row_order)
+        ddjvu_format_set_y_direction(mask_format, pixel_format._y_direction)
+        with nogil:
+            rc = ddjvu_page_render(ddjvu_page, DDJVU_RENDER_FOREGROUND, page_rect, render_rect, ddjvu_format, row_size, memory)
+            if rc:
+                rc = ddjvu_page_render(ddjvu_page, DDJVU_RENDER_MASKONLY, page_rect, render_rect, mask_format, render_rect.w, <char*> mask)
+            if rc:
+                for y in range(render_rect.h):
+                    row = memory + y * row_size
+                    mask_row = mask + y * render_rect.w
+                    for x in range(render_rect.w):
+                        # Black stencil pixels are opaque, white ones are transparent.
+                        memcpy(&pixel, row + 4 * x, 4)
+                        pixel = (pixel & ~alpha_mask) | (((0xFF - mask_row[x]) * alpha_max + 0x7F) // 0xFF) << alpha_shift
+                        memcpy(row + 4 * x, &pixel, 4)
+    finally:
+        if mask_format != NULL:
+            ddjvu_format_release(mask_format)
+        py_free(mask)
+    return rc
+
+cdef class _PageTiles:
+
+    cdef PageJob _job
+    cdef ddjvu_render_mode_t _mode
+    cdef ddjvu_rect_t _page_rect
+    cdef unsigned int _tile_w, _tile_h
+    cdef unsigned int _x, _y
+    cdef PixelFormat _pixel_format
+    cdef long _row_alignment
+    cdef object _buffer
+    cdef object _memview
+    cdef void *_memory
+    cdef int _slice
+
+    def __cinit__(self, PageJob job not None, ddjvu_render_mode_t mode, page_rect, tile_size, PixelFormat pixel_format not None, long row_alignment, buffer, int reuse_memory=0):
+        cdef long x, y, w, h
+        cdef long tile_w, tile_h
+        cdef long row_size
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        x, y, w, h = page_rect
+        if w <= 0 or h <= 0:
+            raise ValueError('page_rect width/height must be a positive integer')
+        self._page_rect.x, self._page_rect.y, self._page_rect.w, self._page_rect.h = x, y, w, h
+        if self._page_rect.x != x or self._page_rect.y != y or self._page_rect.w != w or self._page_rect.h != h:
+            raise OverflowError('page_rect coordinates are too large')
+        if int(x) + (w - 1) > INT_MAX or int(y) + (h - 1) > INT_MAX:
+            raise OverflowError('page_rect coordinates are too large')
+        if is_int(tile_size):
+            tile_w = tile_h = tile_size
+        else:
+            tile_w, tile_h = tile_size
+        if tile_w <= 0 or tile_h <= 0:
+            raise ValueError('tile_size must be a positive integer')
+        self._tile_w = min(tile_w, self._page_rect.w)
+        self._tile_h = min(tile_h, self._page_rect.h)
+        self._x = self._y = 0
+        self._job = job
+        self._mode = mode
+        self._pixel_format = pixel_format
+        self._row_alignment = row_alignment
+        self._buffer = buffer
+        self._memview = None
+        self._memory = NULL
+        self._slice = 0
+        row_size = calculate_row_size(self._tile_w, row_alignment, pixel_format._bpp)
+        if buffer is None and reuse_memory:
+            # Every tile is rendered into the same memory, and a memoryview
+            # of the tile's part of it is returned.
+            buffer = bytearray(row_size * self._tile_h)
+            self._slice = 1
+        if buffer is not None and not typecheck(buffer, BufferPool):
+            (self._buffer, self._memview) = allocate_image_memory(row_size, self._tile_h, buffer, &self._memory)
+
+    cdef int next_rect(self, ddjvu_rect_t *render_rect, unsigned int *top):
+        # Compute the rectangle of the next tile, and its distance (in rows)
+        # from the top of page_rect. Return 0 if there are no more tiles.
+        if self._y >= self._page_rect.h:
+            return 0
+        top[0] = self._y
+        render_rect.x = self._page_rect.x + <int> self._x
+        render_rect.w = min(self._tile_w, self._page_rect.w - self._x)
+        render_rect.h = min(self._tile_h, self._page_rect.h - self._y)
+        if self._pixel_format._y_direction:
+            render_rect.y = self._page_rect.y + <int> self._y
+        else:
+            # Tiles are laid out from the top of the image even if the y
+            # coordinates are oriented from bottom to top.
+            render_rect.y = self._page_rect.y + <int> (self._page_rect.h - self._y - render_rect.h)
+        self._x += render_rect.w
+        if self._x >= self._page_rect.w:
+            self._x = 0
+            self._y += render_rect.h
+        return 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef ddjvu_rect_t c_render_rect
+        cdef unsigned int top
+        cdef long row_size
+        cdef void *memory
+        cdef ddjvu_page_t* ddjvu_page
+        cdef int rc
+        if not self.next_rect(&c_render_rect, &top):
+            raise StopIteration
+        row_size = calculate_row_size(c_render_rect.w, self._row_alignment, self._pixel_format._bpp)
+        if self._memory == NULL:
+            (result, memview) = allocate_image_memory(row_size, c_render_rect.h, self._buffer, &memory)
+        elif self._slice:
+            result = memoryview(self._buffer)[:row_size * c_render_rect.h]
+            memory = self._memory
+        else:
+            result = self._buffer
+            memory = self._memory
+        ddjvu_page = <ddjvu_page_t*> self._job.ddjvu_job
+        rc = render_page(ddjvu_page, self._mode, &self._page_rect, &c_render_rect, self._pixel_format, row_size, <char*> memory)
+        if rc == 0:
+            raise _NotAvailable_
+        return ((c_render_rect.x, c_render_rect.y, c_render_rect.w, c_render_rect.h), result)
 
 cdef class PageJob(Job):
 
@@ -2132,6 +3900,9 @@ cdef class PageJob(Job):
             color background layer
         RENDER_FOREGROUND
             color foreground layer
+        RENDER_FOREGROUND_ALPHA
+            color foreground layer, with the stencil as the alpha channel
+            (only for 32-bit PixelFormatRgbMask pixel formats)
 
         Conceptually this method renders the full page into a rectangle
         page_rect and copies the pixels specified by rectangle
@@ -2142,10 +3913,21 @@ cdef class PageJob(Job):
         at row_alignment bytes boundary.
 
         Data will be saved to the provided buffer or to a newly created string.
+        If buffer is a BufferPool, data will be saved to a PooledBuffer taken
+        from the pool.
+
+        If a RenderCache is assigned to the context, images of fully decoded
+        pages are looked up in (and stored to) the cache.
 
         This method makes a best effort to compute an image that reflects the
         most recently decoded data.
 
+        The GIL is released while the image is being rendered. Different page
+        jobs, either of the same document or of different documents of the
+        same context, can be rendered concurrently from multiple threads.
+        The page job and the pixel format must not be modified while
+        rendering is in progress.
+
         Possible exceptions: NotAvailable (to indicate that no image could be
         computed at this point.)
         '''
@@ -2156,6 +3938,8 @@ cdef class PageJob(Job):
         cdef int bpp
         cdef long x, y, w, h
         cdef void *memory
+        cdef ddjvu_page_t* ddjvu_page
+        cdef int rc
         if row_alignment <= 0:
             raise ValueError('row_alignment must be a positive integer')
         x, y, w, h = page_rect
@@ -2178,20 +3962,461 @@ cdef class PageJob(Job):
         ):
             raise ValueError('render_rect must be inside page_rect')
         row_size = calculate_row_size(c_render_rect.w, row_alignment, pixel_format._bpp)
+        cache = self._context._render_cache
+        cache_key = None
+        if cache is not None and self._page is not None:
+            cache_key = (
+                self._page._document, self._page._n,
+                <int> ddjvu_page_get_rotation(<ddjvu_page_t*> self.ddjvu_job), mode,
+                (c_page_rect.x, c_page_rect.y, c_page_rect.w, c_page_rect.h),
+                (c_render_rect.x, c_render_rect.y, c_render_rect.w, c_render_rect.h),
+                get_pixel_format_key(pixel_format), row_alignment,
+            )
+            data = cache.lookup(cache_key)
+            if data is not None:
+                if buffer is None:
+                    return data
+                (result, memview) = allocate_image_memory(row_size, c_render_rect.h, buffer, &memory)
+                memcpy(memory, <char*> data, len(data))
+                return result
         (result, memview) = allocate_image_memory(row_size, c_render_rect.h, buffer, &memory)
-        if ddjvu_page_render(<ddjvu_page_t*> self.ddjvu_job, mode, &c_page_rect, &c_render_rect, pixel_format.ddjvu_format, row_size, <char*> memory) == 0:
+        ddjvu_page = <ddjvu_page_t*> self.ddjvu_job
+        # The image memory is kept alive (and, for buffer-protocol objects,
+        # locked) by result and memview until the rendering is finished.
+        rc = render_page(ddjvu_page, mode, &c_page_rect, &c_render_rect, pixel_format, row_size, <char*> memory)
+        if rc == 0:
             raise _NotAvailable_
+        if cache_key is not None and ddjvu_job_done(self.ddjvu_job):
+            if buffer is None:
+                data = result
+            else:
+                data = charp_to_bytes(<char*> memory, row_size * c_render_rect.h)
+            cache.store(cache_key, data)
         return result
 
+    def render_image(self, ddjvu_render_mode_t mode, page_rect, render_rect, PixelFormat pixel_format not None, long row_alignment=1, BufferPool pool=None):
+        '''
+        J.render_image(mode, page_rect, render_rect, pixel_format, row_alignment=1, pool=None) -> an ImageBuffer
+
+        Render a segment of a page, like J.render(...) does, but return an
+        ImageBuffer, which exposes the image through the buffer protocol,
+        together with its shape, strides and item format. NumPy arrays,
+        memoryviews and other consumers can then wrap the image without
+        copying.
+
+        The image memory is taken from pool, if provided.
+
+        Supported pixel formats are: PixelFormatRgb, PixelFormatRgbMask,
+        PixelFormatGrey and PixelFormatPalette.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        '''
+        cdef long x, y, w, h
+        if typecheck(pixel_format, PixelFormatPackedBits):
+            raise ValueError('pixel_format cannot be represented as an image buffer')
+        if pool is None:
+            pool = BufferPool(0)
+        data = self.render(mode, page_rect, render_rect, pixel_format, row_alignment, pool)
+        x, y, w, h = render_rect
+        return ImageBuffer_from_data(data, w, h, calculate_row_size(w, row_alignment, pixel_format._bpp), pixel_format)
+
+    def progressive_render(self, ddjvu_render_mode_t mode, page_rect, render_rect, PixelFormat pixel_format not None, long row_alignment=1, double min_interval=0.1):
+        '''
+        J.progressive_render(mode, page_rect, render_rect, pixel_format, row_alignment=1, min_interval=0.1)
+          -> an iterator of data
+
+        Render a segment of a page, like J.render(...) does, every time newly
+        decoded data provides a better image, i.e. after receiving
+        a PageInfoMessage, a RelayoutMessage or a RedisplayMessage.
+        Images are yielded at most once per min_interval seconds.
+
+        The iterator finishes when the job is done; the last image reflects
+        the fully decoded page.
+
+        This method doesn't consume messages from the internal job queue,
+        and it works regardless of how C.handle_message(...) dispatches them.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        '''
+        if min_interval < 0:
+            raise ValueError('min_interval must be a non-negative number')
+        notifications = [0]
+        def watcher():
+            # This runs in the message distributor thread, with the condition
+            # acquired, for every message (including filtered ones) concerning
+            # the job.
+            notifications[0] += 1
+            return False
+        with self._condition:
+            self._watchers += [watcher]
+        try:
+            seen = 0
+            dirty = True
+            last_time = None
+            while True:
+                if ddjvu_job_done(self.ddjvu_job):
+                    if self.is_error:
+                        raise self.status
+                    yield self.render(mode, page_rect, render_rect, pixel_format, row_alignment)
+                    return
+                timeout = None
+                if dirty:
+                    now = timer()
+                    if last_time is not None:
+                        timeout = last_time + min_interval - now
+                    if timeout is None or timeout <= 0:
+                        try:
+                            data = self.render(mode, page_rect, render_rect, pixel_format, row_alignment)
+                        except NotAvailable:
+                            pass
+                        else:
+                            last_time = now
+                            yield data
+                        dirty = False
+                        timeout = None
+                with self._condition:
+                    if notifications[0] == seen and not ddjvu_job_done(self.ddjvu_job):
+                        self._condition.wait(timeout)
+                    if notifications[0] != seen:
+                        seen = notifications[0]
+                        dirty = True
+        finally:
+            with self._condition:
+                try:
+                    self._watchers.remove(watcher)
+                except ValueError:
+                    pass
+
+    def render_tiles(self, ddjvu_render_mode_t mode, page_rect, tile_size, PixelFormat pixel_format not None, long row_alignment=1, buffer=None):
+        '''
+        J.render_tiles(mode, page_rect, tile_size, pixel_format, row_alignment=1, buffer=None) -> iterator of (render_rect, data)
+
+        Render the full page into a rectangle page_rect, split into tiles
+        of tile_size pixels. tile_size is either an integer or a (width,
+        height) tuple. Tiles in the last column and in the last row are
+        smaller if the page_rect dimensions are not multiples of the tile
+        size.
+
+        Tiles are yielded row by row, starting from the top-left corner of the
+        image (regardless of the y coordinates orientation), as pairs of
+        render_rect and image data. For every tile, the data is the same as
+        J.render(mode, page_rect, render_rect, pixel_format, row_alignment)
+        would return.
+
+        If buffer is provided, data of every tile is saved to this buffer,
+        overwriting the previous tile, and the buffer itself is yielded.
+        The buffer must be large enough to hold the largest tile.
+        If buffer is a BufferPool, every tile is saved to a PooledBuffer
+        taken from the pool. Otherwise, a new string is created for every
+        tile.
+
+        See J.render(...) for the description of the other arguments and for
+        thread-safety notes.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        '''
+        return _PageTiles(self, mode, page_rect, tile_size, pixel_format, row_alignment, buffer)
+
+    def render_bands(self, ddjvu_render_mode_t mode, page_rect, long band_height, PixelFormat pixel_format not None, long row_alignment=1, buffer=None):
+        '''
+        J.render_bands(mode, page_rect, band_height, pixel_format, row_alignment=1, buffer=None) -> iterator of (render_rect, data)
+
+        Render the full page into a rectangle page_rect, split into
+        horizontal bands of band_height rows. The last band is smaller if
+        the page_rect height is not a multiple of band_height.
+
+        Bands are yielded from the top to the bottom of the image, as pairs of
+        render_rect and image data, so that the image can be streamed to an
+        encoder or a file without keeping it in memory as a whole. Rows within
+        each band are ordered according to pixel_format.rows_top_to_bottom.
+
+        All the bands are rendered into the same memory. If buffer is
+        provided, it is used and yielded for every band; it must be large
+        enough to hold a full band. Otherwise, a memoryview of the band data
+        is yielded. In either case, the data is valid only until the next
+        band is rendered. (If buffer is a BufferPool, every band is saved to
+        a PooledBuffer taken from the pool instead.)
+
+        See J.render(...) for the description of the other arguments and for
+        thread-safety notes.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        '''
+        cdef long x, y, w, h
+        if band_height <= 0:
+            raise ValueError('band_height must be a positive integer')
+        x, y, w, h = page_rect
+        return _PageTiles(self, mode, page_rect, (max(w, 1), band_height), pixel_format, row_alignment, buffer, reuse_memory=True)
+
+    def save_image(self, file, format='png', ddjvu_render_mode_t mode=DDJVU_RENDER_COLOR, page_rect=None, PixelFormat pixel_format=None, long band_height=64):
+        '''
+        J.save_image(file, format='png', mode=RENDER_COLOR, page_rect=None, pixel_format=None, band_height=64) -> None
+
+        Render the full page into a rectangle page_rect (by default, the
+        natural size of the page) and save it to the binary file-like object
+        file, in one of the following formats:
+
+        'png'
+            PNG image; pixel_format defaults to RGB, or to RGBA (with the
+            stencil as the alpha channel) if mode is RENDER_FOREGROUND_ALPHA;
+            grey and big-endian packed bits pixel formats are also supported;
+            with other modes, the alpha channel of an RGBA pixel_format is
+            saved as opaque
+        'ppm'
+            PPM image; pixel_format defaults to RGB
+        'pgm'
+            PGM image; pixel_format defaults to grey
+        'pbm'
+            PBM image; pixel_format defaults to big-endian packed bits
+
+        The image is rendered and encoded in bands of band_height rows, so
+        that neither the whole uncompressed image nor the whole encoded image
+        is kept in memory. Nothing is written to file if the arguments are
+        invalid or the first band cannot be rendered.
+
+        See J.render(...) for the description of the other arguments.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        '''
+        cdef long x, y, w, h, line_size
+        cdef long i, j, band_h, stride, offset
+        cdef int bit_depth, color_type
+        cdef int png = format == 'png'
+        if band_height <= 0:
+            raise ValueError('band_height must be a positive integer')
+        if png:
+            if pixel_format is None:
+                if <int> mode == FOREGROUND_ALPHA_MODE:
+                    (r, g, b, a) = get_rgba_masks()
+                    pixel_format = PixelFormatRgbMask(r, g, b, a, bpp=32)
+                else:
+                    pixel_format = PixelFormatRgb()
+            (bit_depth, color_type, invert, opaque) = get_png_format(pixel_format, mode)
+        elif format in ('ppm', 'pgm', 'pbm'):
+            (pixel_format, header) = get_pnm_pixel_format(format, pixel_format)
+        else:
+            raise ValueError("format must be equal to 'png', 'ppm', 'pgm' or 'pbm'")
+        if <int> mode == FOREGROUND_ALPHA_MODE:
+            get_alpha_mask(pixel_format)
+        if page_rect is None:
+            page_rect = (0, 0, self.width, self.height)
+        x, y, w, h = page_rect
+        bands = _PageTiles(self, mode, page_rect, (max(w, 1), band_height), pixel_format, 1, None, reuse_memory=True)
+        line_size = calculate_row_size(w, 1, pixel_format._bpp)
+        # Render the first band before writing anything, so that the file is
+        # left untouched if the image cannot be rendered.
+        entry = next(bands)
+        if png:
+            file.write(b'\x89PNG\r\n\x1A\n')
+            write_png_chunk(file, b'IHDR', struct_pack('>IIBBBBB', w, h, bit_depth, color_type, 0, 0, 0))
+            compressor = compressobj()
+            # In PNG, each row is prefixed with the filter type; 0 means no
+            # filtering.
+            offset = 1
+        else:
+            file.write(header.format(w=w, h=h).encode('ASCII'))
+            offset = 0
+        stride = offset + line_size
+        # Rows are copied into this buffer if they need to be reordered or
+        # prefixed.
+        rows = bytearray(min(band_height, h) * stride)
+        while entry is not None:
+            (rect, data) = entry
+            band_h = rect[3]
+            if not png and pixel_format._row_order:
+                file.write(data)
+            else:
+                for i in range(band_h):
+                    if pixel_format._row_order:
+                        j = i
+                    else:
+                        j = band_h - 1 - i
+                    rows[i * stride + offset:(i + 1) * stride] = data[j * line_size:(j + 1) * line_size]
+                if band_h * stride == len(rows):
+                    band = rows
+                else:
+                    band = rows[:band_h * stride]
+                if not png:
+                    file.write(band)
+                else:
+                    if invert:
+                        band = band.translate(PNG_INVERT_TABLE)
+                        band[::stride] = bytearray(band_h)
+                    if opaque:
+                        for i in range(band_h):
+                            band[i * stride + 4:(i + 1) * stride:4] = b'\xFF' * w
+                    compressed = compressor.compress(band)
+                    if compressed:
+                        write_png_chunk(file, b'IDAT', compressed)
+            entry = next(bands, None)
+        if png:
+            write_png_chunk(file, b'IDAT', compressor.flush())
+            write_png_chunk(file, b'IEND', b'')
+
+    def render_to_file(self, path, format='ppm', ddjvu_render_mode_t mode=DDJVU_RENDER_COLOR, page_rect=None, PixelFormat pixel_format=None, long band_height=64):
+        '''
+        J.render_to_file(path, format='ppm', mode=RENDER_COLOR, page_rect=None, pixel_format=None, band_height=64) -> ((w, h, row_size), offset)
+
+        Create a file of the specified path, and render the full page into a
+        rectangle page_rect (by default, the natural size of the page)
+        directly into the memory-mapped file, as an uncompressed image in one
+        of the following formats:
+
+        'ppm'
+            PPM image; pixel_format defaults to RGB
+        'pgm'
+            PGM image; pixel_format defaults to grey
+        'pbm'
+            PBM image; pixel_format defaults to big-endian packed bits
+
+        pixel_format must store rows from the top to the bottom of the image.
+
+        The image is rendered in bands of band_height rows, so only the
+        memory needed for a single band is allocated; the rest of the image
+        stays in the page cache of the file.
+
+        Return a ((w, h, row_size), offset) tuple:
+
+        * w and h are image dimensions in pixels;
+        * row_size is length of each image row, in bytes;
+        * offset is the position of the image data in the file.
+
+        See J.render(...) for the description of the other arguments.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        '''
+        cdef _PageTiles bands
+        cdef ddjvu_rect_t c_band_rect
+        cdef unsigned int top
+        cdef long x, y, w, h
+        cdef long row_size
+        cdef Py_ssize_t offset
+        cdef void *memory
+        cdef ddjvu_page_t* ddjvu_page
+        cdef int rc
+        if band_height <= 0:
+            raise ValueError('band_height must be a positive integer')
+        (pixel_format, header) = get_pnm_pixel_format(format, pixel_format)
+        if not pixel_format._row_order:
+            raise ValueError('pixel_format must store rows from the top to the bottom')
+        if page_rect is None:
+            page_rect = (0, 0, self.width, self.height)
+        x, y, w, h = page_rect
+        bands = _PageTiles(self, mode, page_rect, (max(w, 1), band_height), pixel_format, 1, None)
+        row_size = calculate_row_size(w, 1, pixel_format._bpp)
+        header = header.format(w=w, h=h).encode('ASCII')
+        offset = len(header)
+        size = offset + int(row_size) * h
+        ddjvu_page = <ddjvu_page_t*> self.ddjvu_job
+        with open(path, 'w+b') as file:
+            file.write(header)
+            file.flush()
+            file.truncate(size)
+            image_map = mmap(file.fileno(), size)
+            try:
+                (result, memview) = allocate_image_memory(1, size, image_map, &memory)
+                while bands.next_rect(&c_band_rect, &top):
+                    rc = render_page(ddjvu_page, mode, &bands._page_rect, &c_band_rect, pixel_format, row_size, <char*> memory + offset + top * row_size)
+                    if rc == 0:
+                        raise _NotAvailable_
+            finally:
+                # Exported buffers must be released before closing the map.
+                result = memview = None
+                image_map.close()
+        return ((w, h, row_size), offset)
+
+    def render_pyramid(self, ddjvu_render_mode_t mode, PixelFormat pixel_format not None, tile_size=256, directory=None, sink=None, long row_alignment=1):
+        '''
+        J.render_pyramid(mode, pixel_format, tile_size=256, directory=None, sink=None, row_alignment=1) -> timings
+
+        Wait until the page is decoded, then render all the zoom levels of
+        the page, split into tiles of tile_size pixels, following the Deep
+        Zoom conventions:
+
+        - the highest level has the natural size of the page;
+        - each lower level is half the size of the next one (rounded up);
+        - level 0 is 1 pixel wide or high.
+
+        Tiles are numbered by (column, row), starting from the top-left
+        corner of the image.
+
+        If directory is provided, every tile is saved to
+        directory/level/column_row.ext, as a PPM (for RGB pixel format), PGM
+        (for grey pixel format) or PBM (for big-endian packed bits pixel
+        format) image.
+
+        Otherwise, sink(level, column, row, (w, h, row_size), data) is called
+        for every tile, where row_size is length of each image row, in bytes.
+
+        Return a list of (level, (w, h), n_tiles, seconds) tuples, one per
+        level, where w and h are the level dimensions in pixels, n_tiles is
+        the number of tiles, and seconds is the time spent on rendering and
+        saving them.
+
+        See J.render_tiles(...) for the description of the other arguments.
+
+        Possible exceptions: JobFailed (if page decoding failed),
+        NotAvailable.
+        '''
+        cdef int level, max_level, shift
+        cdef long width, height, w, h, tile_w, tile_h
+        cdef long x, y, tw, th, row_size
+        if (directory is None) == (sink is None):
+            raise ValueError('exactly one of directory and sink must be specified')
+        if is_int(tile_size):
+            tile_w = tile_h = tile_size
+        else:
+            tile_w, tile_h = tile_size
+        if tile_w <= 0 or tile_h <= 0:
+            raise ValueError('tile_size must be a positive integer')
+        if directory is not None:
+            (extension, header) = get_pnm_header(pixel_format)
+        self.wait()
+        if self.is_error:
+            raise self.status
+        width, height = self.size
+        max_level = 0
+        while (max(width, height) - 1) >> max_level:
+            max_level += 1
+        timings = []
+        for level in range(max_level + 1):
+            shift = max_level - level
+            w = ((width - 1) >> shift) + 1
+            h = ((height - 1) >> shift) + 1
+            start = timer()
+            if directory is not None:
+                level_directory = os_path.join(directory, str(level))
+                if not os_path.isdir(level_directory):
+                    makedirs(level_directory)
+            n = 0
+            for (rect, data) in _PageTiles(self, mode, (0, 0, w, h), (tile_w, tile_h), pixel_format, row_alignment, None):
+                x, y, tw, th = rect
+                if not pixel_format._y_direction:
+                    y = h - y - th
+                row_size = calculate_row_size(tw, row_alignment, pixel_format._bpp)
+                if sink is not None:
+                    sink(level, x // tile_w, y // tile_h, (tw, th, row_size), data)
+                else:
+                    path = os_path.join(level_directory, '{x}_{y}.{ext}'.format(x=x // tile_w, y=y // tile_h, ext=extension))
+                    write_pnm(path, header, tw, th, pixel_format, row_size, data)
+                n += 1
+            timings += [(level, (w, h), n, timer() - start)]
+        return timings
+
     def __dealloc__(self):
         if self.ddjvu_job == NULL:
             return
         ddjvu_page_release(<ddjvu_page_t*> self.ddjvu_job)
         self.ddjvu_job = NULL
 
-cdef PageJob PageJob_from_c(ddjvu_page_t* ddjvu_page):
+cdef PageJob PageJob_from_c(Context context, ddjvu_page_t* ddjvu_page):
     cdef PageJob job
-    job = Job_from_c(<ddjvu_job_t*> ddjvu_page)
+    job = Job_from_c(context, <ddjvu_job_t*> ddjvu_page)
     return job
 
 cdef class Job:
@@ -2205,23 +4430,29 @@ cdef class Job:
         self._context = None
         self.ddjvu_job = NULL
         self._condition = Condition()
-        self._queue = Queue()
+        self._watchers = []
+        self._queue = _MessageQueue()
 
     cdef object _init(self, Context context, ddjvu_job_t *ddjvu_job):
-        # Assumption: loft_lock is already acquired.
+        # Assumption: context._loft_lock is already acquired.
         assert (context is not None) and ddjvu_job != NULL
         self._context = context
         self.ddjvu_job = ddjvu_job
-        _job_loft.add(self)
-        _job_weak_loft[voidp_to_int(ddjvu_job)] = self
+        context._job_loft.add(self)
+        context._job_weak_loft[voidp_to_int(ddjvu_job)] = self
 
     cdef object _clear(self):
+        cdef Context context = self._context
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(context._loft_lock, WAIT_LOCK)
         try:
-            _job_loft.discard(self)
+            context._job_loft.discard(self)
         finally:
-            release_lock(loft_lock)
+            release_lock(context._loft_lock)
+
+    cdef object _finish(self):
+        # Called when the job is known to be done.
+        pass
 
     property status:
         '''
@@ -2244,21 +4475,69 @@ cdef class Job:
         def __get__(self):
             return bool(ddjvu_job_done(self.ddjvu_job))
 
-    def wait(self):
+    def wait(self, timeout=None):
         '''
-        J.wait() -> None
+        J.wait(timeout=None) -> bool
 
-        Wait until the job is done.
+        Wait until the job is done, or until timeout seconds have passed (if
+        timeout is not None).
+
+        Return True if the job is done, False otherwise.
         '''
+        if timeout is not None:
+            deadline = timer() + timeout
         while True:
             self._condition.acquire()
             try:
                 if ddjvu_job_done(self.ddjvu_job):
-                    break
-                self._condition.wait()
+                    return True
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    timeout = deadline - timer()
+                    if timeout <= 0:
+                        return False
+                    self._condition.wait(timeout)
             finally:
                 self._condition.release()
 
+    def wait_async(self):
+        '''
+        J.wait_async() -> an asyncio future
+
+        Asynchronous counterpart of J.wait().
+        '''
+        def check():
+            if not ddjvu_job_done(self.ddjvu_job):
+                return the_sentinel
+        return watch(self._condition, self._watchers, check)
+
+    def as_future(self):
+        '''
+        J.as_future() -> a concurrent.futures.Future
+
+        Return a future, which is completed by the message distributor thread
+        when the job is done. Its result is the job itself; if the job failed
+        or was stopped, the future raises JobFailed or JobStopped instead.
+
+        Cancelling the future attempts to stop the job (see J.stop()).
+        '''
+        future = get_job_future_class()(self)
+        def watcher():
+            if not ddjvu_job_done(self.ddjvu_job):
+                return False
+            self._finish()
+            if future.set_running_or_notify_cancel():
+                if ddjvu_job_error(self.ddjvu_job):
+                    future.set_exception(self.status())
+                else:
+                    future.set_result(self)
+            return True
+        with self._condition:
+            if not watcher():
+                self._watchers += [watcher]
+        return future
+
     def stop(self):
         '''
         J.stop() -> None
@@ -2289,6 +4568,21 @@ cdef class Job:
         except Empty:
             return
 
+    def get_message_async(self):
+        '''
+        J.get_message_async() -> an asyncio future
+
+        Get message from the internal job queue, as soon as one is
+        available.
+
+        Asynchronous iteration (async for) yields messages obtained this way.
+        Cancelling the future never loses a message.
+        '''
+        return watch_queue(self._condition, self._watchers, self._queue)
+
+    def __aiter__(self):
+        return _AsyncMessageIterator(self)
+
     def __iter__(self):
         return self
 
@@ -2301,19 +4595,108 @@ cdef class Job:
         ddjvu_job_release(self.ddjvu_job)
         self.ddjvu_job = NULL
 
-cdef Job Job_from_c(ddjvu_job_t* ddjvu_job):
+cdef object JobFuture
+JobFuture = None
+
+cdef object get_job_future_class():
+    global JobFuture
+    if JobFuture is not None:
+        return JobFuture
+    from concurrent.futures import Future
+    class JobFuture(Future):
+
+        def __init__(self, job):
+            Future.__init__(self)
+            self._job = job
+
+        def cancel(self):
+            if not self.done():
+                self._job.stop()
+            return Future.cancel(self)
+
+    return JobFuture
+
+cdef Job Job_from_c(Context context, ddjvu_job_t* ddjvu_job):
     cdef Job result
     if ddjvu_job == NULL:
-        result = None
-    else:
+        return None
+    key = voidp_to_int(ddjvu_job)
+    # Fast path: dictionary lookups are atomic under the GIL, so no lock is
+    # needed.
+    result = context._job_weak_loft.get(key)
+    if result is None:
+        # The job might be being registered right now.
         with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
+            acquire_lock(context._loft_lock, WAIT_LOCK)
         try:
-            result = _job_weak_loft.get(voidp_to_int(ddjvu_job))
+            result = context._job_weak_loft.get(key)
         finally:
-            release_lock(loft_lock)
+            release_lock(context._loft_lock)
     return result
 
+cdef object wait_for_jobs(object jobs, object timeout, int all_done):
+    cdef Job job
+    objs = list(jobs)
+    for obj in objs:
+        if not typecheck(obj, Job) and not typecheck(obj, Document):
+            raise TypeError('jobs must be Job or Document instances')
+    jobs = [obj.decoding_job if typecheck(obj, Document) else obj for obj in objs]
+    done = Event()
+    def is_done(Job job):
+        return ddjvu_job_done(job.ddjvu_job)
+    def watcher():
+        # This runs in the message distributor thread, with the condition of
+        # one of the jobs acquired.
+        if done.is_set():
+            return True
+        if all_done:
+            ready = all(imap(is_done, jobs))
+        else:
+            ready = any(imap(is_done, jobs))
+        if ready:
+            done.set()
+        return ready
+    for job in jobs:
+        with job._condition:
+            job._watchers += [watcher]
+    try:
+        if not watcher():
+            done.wait(timeout)
+    finally:
+        for job in jobs:
+            with job._condition:
+                try:
+                    job._watchers.remove(watcher)
+                except ValueError:
+                    pass
+    flags = [is_done(job) for job in jobs]
+    return (
+        [obj for (obj, flag) in izip(objs, flags) if flag],
+        [obj for (obj, flag) in izip(objs, flags) if not flag],
+    )
+
+def wait_any(jobs, timeout=None):
+    '''
+    wait_any(jobs, timeout=None) -> (done, pending)
+
+    Wait until any of the jobs (Job or Document instances) is done, or until
+    timeout seconds have passed (if timeout is not None).
+
+    Return two lists: of the jobs that are done, and of the other jobs.
+    '''
+    return wait_for_jobs(jobs, timeout, 0)
+
+def wait_all(jobs, timeout=None):
+    '''
+    wait_all(jobs, timeout=None) -> (done, pending)
+
+    Wait until all the jobs (Job or Document instances) are done, or until
+    timeout seconds have passed (if timeout is not None).
+
+    Return two lists: of the jobs that are done, and of the other jobs.
+    '''
+    return wait_for_jobs(jobs, timeout, 1)
+
 cdef class AffineTransform:
 
     '''
@@ -2449,9 +4832,9 @@ cdef class Message:
         if self.ddjvu_message == NULL:
             raise SystemError
         self._context = Context_from_c(self.ddjvu_message.m_any.context)
-        self._document = Document_from_c(self.ddjvu_message.m_any.document)
-        self._page_job = PageJob_from_c(self.ddjvu_message.m_any.page)
-        self._job = Job_from_c(self.ddjvu_message.m_any.job)
+        self._document = Document_from_c(self._context, self.ddjvu_message.m_any.document)
+        self._page_job = PageJob_from_c(self._context, self.ddjvu_message.m_any.page)
+        self._job = Job_from_c(self._context, self.ddjvu_message.m_any.job)
 
     property context:
         '''
@@ -2934,6 +5317,14 @@ cdef class DocumentOutline(DocumentExtension):
             finally:
                 self._document._condition.release()
 
+    def wait_async(self):
+        '''
+        O.wait_async() -> an asyncio future
+
+        Asynchronous counterpart of O.wait().
+        '''
+        return watch(self._document._condition, self._document._watchers, wait_for_sexpr(self))
+
     property sexpr:
         '''
         Return the associated S-expression. See "Outline/Bookmark syntax" in
@@ -2996,6 +5387,14 @@ cdef class Annotations:
             finally:
                 self._document._condition.release()
 
+    def wait_async(self):
+        '''
+        A.wait_async() -> an asyncio future
+
+        Asynchronous counterpart of A.wait().
+        '''
+        return watch(self._document._condition, self._document._watchers, wait_for_sexpr(self))
+
     property sexpr:
         '''
         Return the associated S-expression. See "Annotation syntax" in the
@@ -3266,6 +5665,14 @@ cdef class PageText:
             finally:
                 self._page._document._condition.release()
 
+    def wait_async(self):
+        '''
+        PT.wait_async() -> an asyncio future
+
+        Asynchronous counterpart of PT.wait().
+        '''
+        return watch(self._page._document._condition, self._page._document._watchers, wait_for_sexpr(self))
+
     property page:
         '''
         Return the concerned page.
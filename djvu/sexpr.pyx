@@ -102,7 +102,9 @@ cdef object weakref
 import weakref
 
 cdef object symbol_dict
+cdef Lock symbol_lock
 symbol_dict = weakref.WeakValueDictionary()
+symbol_lock = allocate_lock()
 
 cdef object codecs
 import codecs
@@ -413,19 +415,27 @@ class Symbol(BaseSymbol):
         self = None
         if is_unicode(name):
             name = encode_utf8(name)
-        try:
-            if cls is _Symbol_:
-                self = symbol_dict[name]
-        except KeyError:
-            pass
+        if cls is _Symbol_:
+            # Fast path: no lock is needed to find an existing symbol.
+            self = symbol_dict.get(name)
         if self is None:
             if not is_bytes(name):
                 name = str(name)
                 IF PY3K:
                     name = encode_utf8(name)
-            self = BaseSymbol.__new__(cls, name)
-            if cls is _Symbol_:
-                symbol_dict[name] = self
+            if cls is not _Symbol_:
+                return BaseSymbol.__new__(cls, name)
+            # Make sure that concurrent threads don't intern distinct symbols
+            # with the same name.
+            with nogil:
+                acquire_lock(symbol_lock, WAIT_LOCK)
+            try:
+                self = symbol_dict.get(name)
+                if self is None:
+                    self = BaseSymbol.__new__(cls, name)
+                    symbol_dict[name] = self
+            finally:
+                release_lock(symbol_lock)
         return self
 
 cdef object _Symbol_
@@ -507,10 +517,15 @@ class Expression(BaseExpression):
         cdef _ExpressionIO xio
         try:
             xio = _ExpressionIO(stdin=stdin)
+            # Other threads may allocate (and trigger garbage collection)
+            # before the expression is wrapped.
+            gc_lock(NULL)  # protect from collecting a just-read object
             try:
                 return _c2py(xio.read())
             except InvalidExpression:
                 raise ExpressionSyntaxError
+            finally:
+                gc_unlock(NULL)
         finally:
             xio.close()
 
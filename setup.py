@@ -225,6 +225,9 @@ class build_ext(distutils.command.build_ext.build_ext):
             def build_c(source, target):
                 if cython_version < req_cython_version:
                     raise distutils.errors.DistutilsError('Cython >= {ver} is required'.format(ver=req_cython_version))
+                # The modules rely on the GIL, so they are not declared
+                # free-threading compatible; free-threaded Python re-enables
+                # the GIL when importing them.
                 distutils.spawn.spawn([
                     sys.executable, '-m', 'cython',
                     '-I', os.path.dirname(self.config_path),
@@ -15,12 +15,18 @@
 
 import array
 import errno
+import gc
+import io
 import os
 import re
 import shutil
+import struct
 import sys
 import tempfile
+import threading
 import warnings
+import weakref
+import zlib
 
 if sys.version_info >= (3, 2):
     import subprocess
@@ -35,7 +41,10 @@ else:
 
 from djvu.decode import (
     AffineTransform,
+    BufferPool,
+    ChunkMessage,
     Context,
+    ContextPool,
     DDJVU_VERSION,
     DOCUMENT_TYPE_BUNDLED,
     DOCUMENT_TYPE_SINGLE_PAGE,
@@ -46,8 +55,10 @@ from djvu.decode import (
     DocumentOutline,
     ErrorMessage,
     File,
+    FileInfos,
     FileUri,
     Hyperlinks,
+    ImageBuffer,
     Job,
     JobFailed,
     JobOK,
@@ -58,6 +69,8 @@ from djvu.decode import (
     PAGE_TYPE_BITONAL,
     Page,
     PageAnnotations,
+    PageInfoMessage,
+    PageInfos,
     PageJob,
     PageText,
     PixelFormat,
@@ -66,7 +79,15 @@ from djvu.decode import (
     PixelFormatPalette,
     PixelFormatRgb,
     PixelFormatRgbMask,
+    PooledBuffer,
+    ProgressMessage,
     RENDER_COLOR,
+    RENDER_FOREGROUND,
+    RENDER_FOREGROUND_ALPHA,
+    RENDER_MASK_ONLY,
+    RedisplayMessage,
+    RelayoutMessage,
+    RenderCache,
     SaveJob,
     Stream,
     TEXT_DETAILS_ALL,
@@ -79,6 +100,8 @@ from djvu.decode import (
     TEXT_DETAILS_WORD,
     ThumbnailMessage,
     __version__,
+    wait_all,
+    wait_any,
 )
 from djvu.sexpr import (
     Expression,
@@ -94,6 +117,7 @@ from tools import (
     assert_is_instance,
     assert_list_equal,
     assert_multi_line_equal,
+    assert_not_equal,
     assert_raises,
     assert_raises_regex,
     assert_raises_str,
@@ -178,6 +202,200 @@ def test_context_cache():
         n = (n + 1) * 2 - 1
     context.clear_cache()
 
+def get_page_job_messages(context):
+    document = context.new_document(FileUri(images + 'test1.djvu'))
+    document.decoding_job.wait()
+    job = document.pages[0].decode()
+    return get_job_messages(job)
+
+def get_job_messages(job):
+    messages = []
+    while True:
+        message = job.get_message(wait=False)
+        if message is None:
+            break
+        messages += [message]
+    return messages
+
+@testcase
+def test_context_close():
+    def start_context():
+        threads = set(threading.enumerate())
+        context = Context()
+        [thread] = set(threading.enumerate()) - threads
+        assert_true(thread.is_alive())
+        return (context, thread)
+    (context, thread) = start_context()
+    with context:
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        page_job = document.pages[0].decode()
+    assert_false(thread.is_alive())
+    context.close()
+    with assert_raises_str(ValueError, 'operation on a closed context'):
+        context.new_document(FileUri(images + 'test1.djvu'))
+    with assert_raises_str(ValueError, 'operation on a closed context'):
+        context.cache_size
+    with assert_raises_str(ValueError, 'operation on a closed context'):
+        context.clear_cache()
+    rect = (0, 0, 64, 48)
+    assert_equal(len(page_job.render(RENDER_COLOR, rect, rect, PixelFormatGrey())), 64 * 48)
+    (context, thread) = start_context()
+    context.new_document('dummy://dummy.djvu')
+    context.close()
+    assert_false(thread.is_alive())
+
+@testcase
+def test_concurrent_page_jobs():
+    contexts = [Context(), Context()]
+    documents = []
+    for context in contexts:
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        document.decoding_job.wait()
+        documents += [document]
+    results = []
+    def decode(document):
+        for page in document.pages:
+            job = page.decode(wait=False)
+            results.append((document, job, job.wait()))
+    threads = [
+        threading.Thread(target=decode, args=(document,))
+        for document in documents
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(len(results), 8 * len(documents[0].pages))
+    for document, job, done in results:
+        assert_true(done)
+        assert_equal(job.status, JobOK)
+        messages = get_job_messages(job)
+        assert_true(len(messages) > 0)
+        for message in messages:
+            assert_true(message.job is job)
+            assert_true(message.document is document)
+    for context in contexts:
+        context.close()
+
+class test_context_pools(TestCase):
+
+    def test_bad_new(self):
+        with assert_raises_str(ValueError, 'n must be a positive integer'):
+            ContextPool(0)
+        with assert_raises_str(TypeError, 'context_class must be a Context subclass'):
+            ContextPool(2, context_class=object)
+
+    def test_new_document(self):
+        with ContextPool(2) as pool:
+            assert_equal(len(pool), 2)
+            assert_equal([type(context) for context in pool.contexts], [Context, Context])
+            assert_equal(pool.cache_size, 2 * (10 << 20))
+            pool.cache_size = 8 << 20
+            assert_equal([context.cache_size for context in pool.contexts], [4 << 20, 4 << 20])
+            with assert_raises_str(ValueError, '0 < cache_size / n < (2 ** 31) must be satisfied'):
+                pool.cache_size = 1
+            documents = [pool.new_document(FileUri(images + 'test1.djvu')) for i in range(2)]
+            for document in documents:
+                document.decoding_job.wait()
+                assert_equal(len(document.pages), 1)
+            assert_equal([stats['documents'] for stats in pool.get_stats()], [1, 1])
+            assert_equal(pool.get_stats()[0], dict(documents=1, cache_size=4 << 20, dropped_messages=0))
+            documents += [pool.new_document(FileUri(images + 'test0.djvu'), key='eggs') for i in range(2)]
+            # Which context gets the 'eggs' documents depends on hash('eggs'),
+            # but both of them must end up in the same one:
+            assert_equal(sorted(stats['documents'] for stats in pool.get_stats()), [1, 3])
+            for document in documents:
+                document.decoding_job.wait()
+            del document, documents
+            gc.collect()
+            assert_equal([stats['documents'] for stats in pool.get_stats()], [0, 0])
+            pool.clear_cache()
+        with assert_raises_str(ValueError, 'operation on a closed context'):
+            pool.new_document(FileUri(images + 'test1.djvu'))
+
+class test_queue_limits(TestCase):
+
+    def test_drop(self):
+        context = Context()
+        assert_equal(context.dropped_messages, {})
+        context.set_queue_limit(Message, 0)
+        assert_equal(get_page_job_messages(context), [])
+        dropped = context.dropped_messages
+        assert_true(sum(dropped.values()) > 0)
+        for tp in dropped:
+            assert_true(issubclass(tp, Message))
+        context.set_queue_limit(Message, None)
+        assert_true(len(get_page_job_messages(context)) > 0)
+        assert_equal(context.dropped_messages, dropped)
+
+    def test_bounded(self):
+        context = Context()
+        context.set_queue_limit(Message, 1)
+        messages = get_page_job_messages(context)
+        assert_equal(len(messages), 1)
+        context = Context()
+        context.set_queue_limit(Message, 2, drop_oldest=False)
+        context.set_queue_limit(ChunkMessage, 0)
+        messages = get_page_job_messages(context)
+        assert_true(len(messages) <= 2)
+        for message in messages:
+            assert_false(isinstance(message, ChunkMessage))
+
+    def test_unfinished_tasks(self):
+        context = Context()
+        context.set_queue_limit(Message, 1)
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        job = document.pages[0].decode()
+        queue = job.message_queue
+        assert_equal(queue.qsize(), 1)
+        queue.get_nowait()
+        queue.task_done()
+        # Dropped messages don't count as unfinished tasks:
+        queue.join()
+
+    def test_bad_args(self):
+        context = Context()
+        with assert_raises_str(TypeError, 'message_type must be a Message subclass'):
+            context.set_queue_limit(42, 0)
+        with assert_raises_str(TypeError, 'message_type must be a Message subclass'):
+            context.set_queue_limit(Document, 0)
+        with assert_raises_str(ValueError, 'max_size must be a non-negative integer or None'):
+            context.set_queue_limit(Message, -1)
+
+class test_message_filters(TestCase):
+
+    def test_filter(self):
+        context = Context()
+        assert_equal(context.message_filter, frozenset())
+        context.set_message_filter([ChunkMessage, ProgressMessage])
+        assert_equal(
+            context.message_filter,
+            frozenset([ChunkMessage, RelayoutMessage, RedisplayMessage, ProgressMessage])
+        )
+        messages = get_page_job_messages(context)
+        for message in messages:
+            assert_false(isinstance(message, (ChunkMessage, ProgressMessage)))
+        context.set_message_filter()
+        assert_equal(context.message_filter, frozenset())
+
+    def test_wakeup(self):
+        context = Context()
+        context.set_message_filter([Message])
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        assert_true(document.decoding_job.wait(timeout=10))
+        job = document.pages[1].decode(wait=False)
+        assert_true(job.wait(timeout=10))
+        assert_is(job.get_message(wait=False), None)
+        assert_is(document.get_message(wait=False), None)
+
+    def test_bad_args(self):
+        context = Context()
+        with assert_raises_str(TypeError, 'message_types must be Message subclasses'):
+            context.set_message_filter([42])
+
 class test_documents(TestCase):
 
     def test_bad_new(self):
@@ -444,12 +662,171 @@ class test_documents(TestCase):
             expected = '1 Lorem ipsum'
             assert_multi_line_equal(stdout, expected)
 
+    def test_render_pages(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        document.decoding_job.wait()
+        pixel_format = PixelFormatGrey()
+        expected = []
+        for page in document.pages:
+            page_job = page.decode()
+            (w, h) = (page_job.width // 10, page_job.height // 10)
+            data = page_job.render(RENDER_COLOR, (0, 0, w, h), (0, 0, w, h), pixel_format, 4)
+            expected += [(page.n, (w, h, (w + 3) // 4 * 4), data)]
+        assert_equal(expected[0][1], (255, 330, 256))
+        results = document.render_pages(None, RENDER_COLOR, pixel_format, dpi=30, row_alignment=4, workers=2)
+        assert_equal(list(results), expected)
+        results = document.render_pages([1, 0], RENDER_COLOR, pixel_format, scale=0.1, row_alignment=4, workers=2, ordered=False)
+        assert_equal(sorted(results), expected)
+        results = document.render_pages([1, 0, 1], RENDER_COLOR, pixel_format, scale=0.1, row_alignment=4, workers=1, max_pending=1)
+        assert_equal(list(results), [expected[1], expected[0], expected[1]])
+        with assert_raises_str(ValueError, 'dpi and scale cannot be both specified'):
+            document.render_pages(None, RENDER_COLOR, pixel_format, dpi=30, scale=0.1)
+        with assert_raises_str(ValueError, 'max_pending must not be smaller than workers'):
+            document.render_pages(None, RENDER_COLOR, pixel_format, workers=2, max_pending=1)
+        with assert_raises_str(IndexError, 'page number out of range'):
+            list(document.render_pages([0, 2], RENDER_COLOR, pixel_format, workers=2))
+        # All the pages are rendered even if the document is not decoded yet:
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        results = document.render_pages(None, RENDER_COLOR, pixel_format, dpi=30, row_alignment=4, workers=2)
+        assert_equal(list(results), expected)
+
+    def test_thumbnails(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        document.decoding_job.wait()
+        pixel_format = PixelFormatGrey()
+        expected = []
+        for page in document.pages:
+            thumbnail = page.thumbnail
+            thumbnail.wait()
+            assert_equal(thumbnail.status, JobOK)
+            (geometry, data) = thumbnail.render((32, 32), pixel_format, 4)
+            expected += [(page.n, geometry, data)]
+        results = document.thumbnails((32, 32), pixel_format, row_alignment=4, workers=2)
+        assert_equal(list(results), expected)
+        results = document.thumbnails((32, 32), pixel_format, [1, 0], row_alignment=4, workers=2, ordered=False)
+        assert_equal(sorted(results), expected)
+        with assert_raises_str(ValueError, 'size width/height must a positive integer'):
+            document.thumbnails((0, 32), pixel_format)
+        with assert_raises_str(ValueError, 'max_pending must not be smaller than workers'):
+            document.thumbnails((32, 32), pixel_format, workers=2, max_pending=1)
+        with assert_raises_str(IndexError, 'page number out of range'):
+            list(document.thumbnails((32, 32), pixel_format, [0, 2], workers=2))
+        # Thumbnails of all the pages are rendered even if the document is not
+        # decoded yet:
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        results = document.thumbnails((32, 32), pixel_format, row_alignment=4, workers=2)
+        assert_equal(list(results), expected)
+
+    def test_pages(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        document.decoding_job.wait()
+        pages = document.pages
+        page = pages[0]
+        assert_is(pages[0], page)
+        assert_equal([p.n for p in pages], [0, 1])
+        assert_is(list(pages)[0], page)
+        assert_equal([p.n for p in pages[::-1]], [1, 0])
+        assert_is(pages[-2:][0], page)
+        assert_equal(pages[2:], [])
+        with assert_raises_str(TypeError, 'page numbers must be integers'):
+            pages['0']
+        page.get_info()
+        infos = [(p.size, p.dpi, p.rotation, p.version) for p in pages]
+        assert_equal(infos[0][0], (page.width, page.height))
+        page_ref = weakref.ref(page)
+        del page
+        gc.collect()
+        assert_is(page_ref(), None)
+        assert_equal([(p.size, p.dpi, p.rotation, p.version) for p in pages], infos)
+        results = []
+        def get_page():
+            results.append(pages[1])
+        threads = [threading.Thread(target=get_page) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(results), 8)
+        for page in results:
+            assert_is(page, results[0])
+
+    def test_get_page_infos(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        infos = document.get_page_infos()
+        assert_equal(type(infos), PageInfos)
+        for column in infos:
+            assert_equal(type(column), array.array)
+            assert_equal(column.typecode, 'i')
+            assert_equal(len(column), 2)
+        expected = [((p.width, p.height), p.dpi, p.rotation, p.version) for p in document.pages]
+        assert_equal(
+            list(zip(zip(infos.width, infos.height), infos.dpi, infos.rotation, infos.version)),
+            expected
+        )
+        assert_equal(document.get_page_infos(wait=False), infos)
+        other_document = context.new_document(FileUri(images + 'test1.djvu'))
+        try:
+            infos = other_document.get_page_infos(wait=False)
+        except NotAvailable:
+            infos = other_document.get_page_infos()
+        assert_equal(infos, PageInfos(*[array.array('i', [x]) for x in (64, 48, 300, 0, 24)]))
+
+    def test_get_file_infos(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        try:
+            infos = document.files.get_infos(wait=False)
+        except NotAvailable:
+            infos = document.files.get_infos()
+        assert_equal(type(infos), FileInfos)
+        assert_equal(
+            infos,
+            FileInfos('P', array.array('i', [0]), array.array('i', [-1]), (u('test1.djvu'),), (u('test1.djvu'),), (u('test1.djvu'),))
+        )
+        assert_is(document.files.get_infos(), infos)
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        infos = document.files.get_infos()
+        n = len(document.files)
+        for column in infos:
+            assert_equal(len(column), n)
+        expected = []
+        for file in [document.files[i] for i in range(n)]:
+            expected += [(file.type, file.n_page, file.size, file.id, file.name, file.title)]
+        assert_equal(
+            [
+                (tp, None if n_page < 0 else n_page, None if size < 0 else size, id, name, title)
+                for (tp, n_page, size, id, name, title) in zip(*infos)
+            ],
+            expected
+        )
+        for page in document.pages:
+            file = document.files[page]
+            assert_equal(file.n_page, page.n)
+            assert_equal(infos.n_page[file.n], page.n)
+
 class test_pixel_formats(TestCase):
 
     def test_bad_new(self):
         with assert_raises_str(TypeError, "cannot create 'djvu.decode.PixelFormat' instances"):
             PixelFormat()
 
+    def test_flags(self):
+        pf = PixelFormatGrey()
+        assert_false(pf.rows_top_to_bottom)
+        assert_false(pf.y_top_to_bottom)
+        pf.rows_top_to_bottom = 1
+        assert_true(pf.rows_top_to_bottom)
+        assert_false(pf.y_top_to_bottom)
+        pf.y_top_to_bottom = 1
+        assert_true(pf.y_top_to_bottom)
+        pf.rows_top_to_bottom = 0
+        assert_false(pf.rows_top_to_bottom)
+        assert_true(pf.y_top_to_bottom)
+
     def test_rgb(self):
         pf = PixelFormatRgb()
         assert_repr(pf, "djvu.decode.PixelFormatRgb(byte_order = 'RGB', bpp = 24)")
@@ -572,6 +949,409 @@ class test_page_jobs(TestCase):
             s = bytes(buffer)
             assert_equal(s, b'\xFF\xFF\xFF\x00' * 4)
 
+    def test_render_foreground_alpha(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        rect = (0, 0, 64, 48)
+        pixel_format = PixelFormatRgbMask(0xFF0000, 0xFF00, 0xFF, bpp=32)
+        foreground = array.array('I', page_job.render(RENDER_FOREGROUND, rect, rect, pixel_format))
+        mask = array.array('B', page_job.render(RENDER_MASK_ONLY, rect, rect, PixelFormatGrey()))
+        assert_equal(len(foreground), len(mask))
+        expected = array.array('I', [(pixel & 0xFFFFFF) | ((0xFF - alpha) << 24) for (pixel, alpha) in zip(foreground, mask)])
+        assert_true(0xFF000000 in expected)
+        image = array.array('I', page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, pixel_format))
+        assert_equal(image, expected)
+        buffer = array.array('I', [0] * (64 * 48))
+        assert_is(page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, pixel_format, 1, buffer), buffer)
+        assert_equal(buffer, expected)
+        pixel_format = PixelFormatRgbMask(0xFF000000, 0xFF0000, 0xFF00, bpp=32)
+        image = array.array('I', page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, pixel_format))
+        assert_equal(image, array.array('I', [((pixel << 8) & 0xFFFFFFFF) | (pixel >> 24) for pixel in expected]))
+        with assert_raises_str(ValueError, 'RENDER_FOREGROUND_ALPHA requires a 32-bit PixelFormatRgbMask'):
+            page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, PixelFormatRgb())
+        with assert_raises_str(ValueError, 'RENDER_FOREGROUND_ALPHA requires a 32-bit PixelFormatRgbMask'):
+            page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, PixelFormatRgbMask(0xF800, 0x07E0, 0x001F, bpp=16))
+        with assert_raises_str(ValueError, 'pixel_format has no bits left for the alpha channel'):
+            page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, PixelFormatRgbMask(0xFF0000FF, 0xFF00, 0xFF0000, bpp=32))
+        with assert_raises_str(ValueError, 'alpha channel bits of pixel_format must be contiguous'):
+            page_job.render(RENDER_FOREGROUND_ALPHA, rect, rect, PixelFormatRgbMask(0xFF0000, 0xFF00, 0xF0, bpp=32))
+
+    def test_progressive_render(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        page_job = document.pages[0].decode(wait=False)
+        pixel_format = PixelFormatGrey()
+        page_rect = (0, 0, 64, 48)
+        results = list(page_job.progressive_render(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=0))
+        assert_true(page_job.is_done)
+        expected = page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        assert_true(len(results) >= 1)
+        assert_equal(results[-1], expected)
+        results = list(page_job.progressive_render(RENDER_COLOR, page_rect, page_rect, pixel_format))
+        assert_equal(results, [expected])
+        with assert_raises_str(ValueError, 'min_interval must be a non-negative number'):
+            list(page_job.progressive_render(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=-1))
+
+    def test_progressive_render_messages(self):
+        class MyContext(Context):
+            def handle_message(self, message):
+                messages.append(message)
+        messages = []
+        pixel_format = PixelFormatGrey()
+        page_rect = (0, 0, 64, 48)
+        for context in [MyContext(), Context()]:
+            document = context.new_document(FileUri(images + 'test1.djvu'))
+            document.decoding_job.wait()
+            page_job = document.pages[0].decode(wait=False)
+            results = list(page_job.progressive_render(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=0))
+            assert_true(page_job.is_done)
+            assert_equal(results[-1], page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format))
+        assert_true(any(message.page_job is not None for message in messages))
+        # The messages are left for the caller:
+        assert_true(len(get_job_messages(page_job)) > 0)
+        context = Context()
+        context.set_queue_limit(ChunkMessage, 0)
+        context.set_message_filter([PageInfoMessage])
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        page_job = document.pages[0].decode(wait=False)
+        results = list(page_job.progressive_render(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=0))
+        assert_true(page_job.is_done)
+        assert_equal(results[-1], page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format))
+
+    def test_render_image(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 64, 48)
+        rect = (0, 0, 5, 3)
+        pixel_format = PixelFormatRgb()
+        pixel_format.rows_top_to_bottom = True
+        image = page_job.render_image(RENDER_COLOR, page_rect, rect, pixel_format, 4)
+        assert_equal(type(image), ImageBuffer)
+        assert_equal(image.shape, (3, 5, 3))
+        assert_equal(image.strides, (16, 3, 1))
+        assert_equal(image.format, 'B')
+        data = page_job.render(RENDER_COLOR, page_rect, rect, pixel_format, 4)
+        if sys.version_info >= (3, 3):
+            memview = memoryview(image)
+            assert_equal(memview.shape, (3, 5, 3))
+            assert_equal(memview.strides, (16, 3, 1))
+            assert_false(memview.readonly)
+            assert_equal(memview.tobytes(), data[0:15] + data[16:31] + data[32:47])
+        pixel_format = PixelFormatGrey()
+        image = page_job.render_image(RENDER_COLOR, page_rect, rect, pixel_format)
+        assert_equal(image.shape, (3, 5))
+        assert_equal(image.strides, (-5, 1))
+        data = page_job.render(RENDER_COLOR, page_rect, rect, pixel_format)
+        if sys.version_info >= (3, 3):
+            memview = memoryview(image)
+            assert_false(memview.c_contiguous)
+            assert_equal(memview.tobytes(), data[10:15] + data[5:10] + data[0:5])
+        pixel_format = PixelFormatRgbMask(0xFF0000, 0xFF00, 0xFF, bpp=32)
+        pixel_format.rows_top_to_bottom = True
+        pool = BufferPool()
+        image = page_job.render_image(RENDER_COLOR, page_rect, rect, pixel_format, pool=pool)
+        assert_equal((image.shape, image.strides, image.format), ((3, 5), (20, 4), 'I'))
+        data = page_job.render(RENDER_COLOR, page_rect, rect, pixel_format)
+        if sys.version_info >= (3, 3):
+            memview = memoryview(image)
+            assert_true(memview.c_contiguous)
+            assert_equal(memview.tobytes(), data)
+            del memview
+        del image
+        assert_equal(pool.size, 60)
+        with assert_raises_str(ValueError, 'pixel_format cannot be represented as an image buffer'):
+            page_job.render_image(RENDER_COLOR, page_rect, rect, PixelFormatPackedBits('>'))
+        with assert_raises_str(TypeError, "cannot create 'djvu.decode.ImageBuffer' instances"):
+            ImageBuffer()
+
+    def test_render_tiles(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 64, 48)
+        pixel_format = PixelFormatGrey()
+        tiles = list(page_job.render_tiles(RENDER_COLOR, page_rect, (24, 20), pixel_format, 4))
+        rects = [rect for (rect, data) in tiles]
+        assert_equal(rects, [
+            (0, 28, 24, 20), (24, 28, 24, 20), (48, 28, 16, 20),
+            (0, 8, 24, 20), (24, 8, 24, 20), (48, 8, 16, 20),
+            (0, 0, 24, 8), (24, 0, 24, 8), (48, 0, 16, 8),
+        ])
+        for (rect, data) in tiles:
+            assert_equal(data, page_job.render(RENDER_COLOR, page_rect, rect, pixel_format, 4))
+        tiles = list(page_job.render_tiles(RENDER_COLOR, (10, 10, 32, 32), 16, pixel_format))
+        assert_equal([rect for (rect, data) in tiles], [(10, 26, 16, 16), (26, 26, 16, 16), (10, 10, 16, 16), (26, 10, 16, 16)])
+        pixel_format.y_top_to_bottom = True
+        tiles = list(page_job.render_tiles(RENDER_COLOR, (10, 10, 32, 32), 16, pixel_format))
+        assert_equal([rect for (rect, data) in tiles], [(10, 10, 16, 16), (26, 10, 16, 16), (10, 26, 16, 16), (26, 26, 16, 16)])
+        for (rect, data) in tiles:
+            assert_equal(data, page_job.render(RENDER_COLOR, (10, 10, 32, 32), rect, pixel_format))
+        pixel_format = PixelFormatGrey()
+        tiles = list(page_job.render_tiles(RENDER_COLOR, page_rect, 1000, pixel_format))
+        assert_equal(tiles, [(page_rect, page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format))])
+        buffer = array.array('B', b'\0' * (24 * 20 - 1))
+        with assert_raises_str(ValueError, 'Image buffer is too small (480 > 479)'):
+            page_job.render_tiles(RENDER_COLOR, page_rect, (24, 20), pixel_format, 1, buffer)
+        buffer = array.array('B', b'\0' * (24 * 20))
+        for (rect, data) in page_job.render_tiles(RENDER_COLOR, page_rect, (24, 20), pixel_format, 1, buffer):
+            assert_is(data, buffer)
+            (x, y, w, h) = rect
+            s = array_tobytes(buffer)[:(w * h)]
+            assert_equal(s, page_job.render(RENDER_COLOR, page_rect, rect, pixel_format, 1))
+        with assert_raises_str(ValueError, 'page_rect width/height must be a positive integer'):
+            page_job.render_tiles(RENDER_COLOR, (0, 0, -1, -1), 16, pixel_format)
+        with assert_raises_str(ValueError, 'tile_size must be a positive integer'):
+            page_job.render_tiles(RENDER_COLOR, page_rect, (16, 0), pixel_format)
+        with assert_raises_str(ValueError, 'row_alignment must be a positive integer'):
+            page_job.render_tiles(RENDER_COLOR, page_rect, 16, pixel_format, 0)
+
+    def test_render_bands(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 64, 48)
+        pixel_format = PixelFormatGrey()
+        pixel_format.rows_top_to_bottom = True
+        bands = [(rect, data.tobytes()) for (rect, data) in page_job.render_bands(RENDER_COLOR, page_rect, 20, pixel_format)]
+        assert_equal([rect for (rect, data) in bands], [(0, 28, 64, 20), (0, 8, 64, 20), (0, 0, 64, 8)])
+        for (rect, data) in bands:
+            assert_equal(data, page_job.render(RENDER_COLOR, page_rect, rect, pixel_format))
+        assert_equal(b''.join(data for (rect, data) in bands), page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format))
+        bands = list(page_job.render_bands(RENDER_COLOR, page_rect, 20, pixel_format))
+        assert_equal(type(bands[0][1]), memoryview)
+        assert_equal([len(data) for (rect, data) in bands], [64 * 20, 64 * 20, 64 * 8])
+        pixel_format = PixelFormatRgb()
+        buffer = array.array('B', b'\0' * (64 * 3 * 20))
+        for (rect, data) in page_job.render_bands(RENDER_COLOR, page_rect, 20, pixel_format, 1, buffer):
+            assert_is(data, buffer)
+            (x, y, w, h) = rect
+            assert_equal(array_tobytes(buffer)[:(64 * 3 * h)], page_job.render(RENDER_COLOR, page_rect, rect, pixel_format))
+        with assert_raises_str(ValueError, 'Image buffer is too small (3840 > 3839)'):
+            page_job.render_bands(RENDER_COLOR, page_rect, 20, pixel_format, 1, array.array('B', b'\0' * (64 * 3 * 20 - 1)))
+        with assert_raises_str(ValueError, 'band_height must be a positive integer'):
+            page_job.render_bands(RENDER_COLOR, page_rect, 0, pixel_format)
+
+    def test_save_image_pnm(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 64, 48)
+        for (format, pixel_format, header) in [
+            ('ppm', PixelFormatRgb(), b'P6\n64 48\n255\n'),
+            ('pgm', PixelFormatGrey(), b'P5\n64 48\n255\n'),
+            ('pbm', PixelFormatPackedBits('>'), b'P4\n64 48\n'),
+        ]:
+            pixel_format.rows_top_to_bottom = True
+            expected = header + page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+            file = io.BytesIO()
+            assert_is(page_job.save_image(file, format), None)
+            assert_equal(file.getvalue(), expected)
+            file = io.BytesIO()
+            page_job.save_image(file, format, band_height=7)
+            assert_equal(file.getvalue(), expected)
+            file = io.BytesIO()
+            pixel_format.rows_top_to_bottom = False
+            page_job.save_image(file, format, pixel_format=pixel_format, band_height=10)
+            assert_equal(file.getvalue(), expected)
+        file = io.BytesIO()
+        page_job.save_image(file, 'pgm', page_rect=(0, 0, 32, 24))
+        assert_equal(file.getvalue()[:12], b'P5\n32 24\n255\n')
+        assert_equal(len(file.getvalue()), 12 + 32 * 24)
+        with assert_raises_str(ValueError, 'pixel_format cannot be saved as a PPM image'):
+            page_job.save_image(io.BytesIO(), 'ppm', pixel_format=PixelFormatGrey())
+        with assert_raises_str(ValueError, 'pixel_format cannot be saved as a PNM image'):
+            page_job.save_image(io.BytesIO(), 'pbm', pixel_format=PixelFormatPackedBits('<'))
+        with assert_raises_str(ValueError, "format must be equal to 'png', 'ppm', 'pgm' or 'pbm'"):
+            page_job.save_image(io.BytesIO(), 'gif')
+        with assert_raises_str(ValueError, 'band_height must be a positive integer'):
+            page_job.save_image(io.BytesIO(), 'ppm', band_height=0)
+
+    def test_render_to_file(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'image.pnm')
+            for (format, size) in [('ppm', (64, 48, 192)), ('pgm', (64, 48, 64)), ('pbm', (64, 48, 8))]:
+                file = io.BytesIO()
+                page_job.save_image(file, format)
+                expected = file.getvalue()
+                result = page_job.render_to_file(path, format, band_height=10)
+                assert_equal(result, (size, len(expected) - size[1] * size[2]))
+                with open(path, 'rb') as file:
+                    assert_equal(file.read(), expected)
+            pixel_format = PixelFormatGrey()
+            pixel_format.rows_top_to_bottom = True
+            result = page_job.render_to_file(path, 'pgm', page_rect=(0, 0, 32, 24), pixel_format=pixel_format)
+            assert_equal(result, ((32, 24, 32), 12))
+            with open(path, 'rb') as file:
+                assert_equal(file.read(), b'P5\n32 24\n255\n' + page_job.render(RENDER_COLOR, (0, 0, 32, 24), (0, 0, 32, 24), pixel_format))
+            with assert_raises_str(ValueError, 'pixel_format must store rows from the top to the bottom'):
+                page_job.render_to_file(path, 'pgm', pixel_format=PixelFormatGrey())
+            with assert_raises_str(ValueError, "format must be equal to 'ppm', 'pgm' or 'pbm'"):
+                page_job.render_to_file(path, 'png')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_save_image_png(self):
+        def read_png(data):
+            assert_equal(data[:8], b'\x89PNG\r\n\x1A\n')
+            data = data[8:]
+            chunks = []
+            while data:
+                (length,) = struct.unpack('>I', data[:4])
+                tag = data[4:8]
+                chunk = data[8:(8 + length)]
+                (crc,) = struct.unpack('>I', data[(8 + length):(12 + length)])
+                assert_equal(crc, zlib.crc32(tag + chunk) & 0xFFFFFFFF)
+                chunks += [(tag, chunk)]
+                data = data[(12 + length):]
+            assert_equal(chunks[0][0], b'IHDR')
+            assert_equal(chunks[-1], (b'IEND', b''))
+            assert_equal(set(tag for (tag, chunk) in chunks[1:-1]), set([b'IDAT']))
+            ihdr = struct.unpack('>IIBBBBB', chunks[0][1])
+            pixels = zlib.decompress(b''.join(chunk for (tag, chunk) in chunks[1:-1]))
+            return (ihdr, pixels)
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 64, 48)
+        def render(mode, pixel_format):
+            pixel_format.rows_top_to_bottom = True
+            data = page_job.render(mode, page_rect, page_rect, pixel_format)
+            row_size = len(data) // 48
+            return b''.join(b'\0' + data[i * row_size:(i + 1) * row_size] for i in range(48))
+        file = io.BytesIO()
+        assert_is(page_job.save_image(file), None)
+        (ihdr, pixels) = read_png(file.getvalue())
+        assert_equal(ihdr, (64, 48, 8, 2, 0, 0, 0))
+        assert_equal(pixels, render(RENDER_COLOR, PixelFormatRgb()))
+        file = io.BytesIO()
+        page_job.save_image(file, 'png', pixel_format=PixelFormatGrey(), band_height=5)
+        (ihdr, pixels) = read_png(file.getvalue())
+        assert_equal(ihdr, (64, 48, 8, 0, 0, 0, 0))
+        assert_equal(pixels, render(RENDER_COLOR, PixelFormatGrey()))
+        file = io.BytesIO()
+        page_job.save_image(file, 'png', pixel_format=PixelFormatPackedBits('>'))
+        (ihdr, pixels) = read_png(file.getvalue())
+        assert_equal(ihdr, (64, 48, 1, 0, 0, 0, 0))
+        expected = render(RENDER_COLOR, PixelFormatPackedBits('>'))
+        expected = bytearray(expected)
+        for i in range(len(expected)):
+            if i % 9:
+                expected[i] ^= 0xFF
+        assert_equal(pixels, bytes(expected))
+        file = io.BytesIO()
+        page_job.save_image(file, 'png', RENDER_FOREGROUND_ALPHA)
+        (ihdr, pixels) = read_png(file.getvalue())
+        assert_equal(ihdr, (64, 48, 8, 6, 0, 0, 0))
+        if sys.byteorder == 'little':
+            pixel_format = PixelFormatRgbMask(0xFF, 0xFF00, 0xFF0000, bpp=32)
+        else:
+            pixel_format = PixelFormatRgbMask(0xFF000000, 0xFF0000, 0xFF00, bpp=32)
+        assert_equal(pixels, render(RENDER_FOREGROUND_ALPHA, pixel_format))
+        file = io.BytesIO()
+        page_job.save_image(file, 'png', RENDER_COLOR, pixel_format=pixel_format, band_height=7)
+        (ihdr, pixels) = read_png(file.getvalue())
+        assert_equal(ihdr, (64, 48, 8, 6, 0, 0, 0))
+        pixels = bytearray(pixels)
+        assert_equal(pixels[4::4 * 64 + 1], bytearray(b'\xFF' * 48))
+        expected = bytearray(render(RENDER_COLOR, pixel_format))
+        for i in range(48):
+            expected[i * (4 * 64 + 1) + 4:(i + 1) * (4 * 64 + 1):4] = b'\xFF' * 64
+        assert_equal(pixels, expected)
+        with assert_raises_str(ValueError, 'pixel_format cannot be saved as a PNG image'):
+            page_job.save_image(io.BytesIO(), 'png', pixel_format=PixelFormatRgb('BGR'))
+        file = io.BytesIO()
+        with assert_raises_str(ValueError, 'RENDER_FOREGROUND_ALPHA requires a 32-bit PixelFormatRgbMask'):
+            page_job.save_image(file, 'png', RENDER_FOREGROUND_ALPHA, pixel_format=PixelFormatGrey())
+        with assert_raises_str(ValueError, 'RENDER_FOREGROUND_ALPHA requires a 32-bit PixelFormatRgbMask'):
+            page_job.save_image(file, 'pgm', RENDER_FOREGROUND_ALPHA)
+        with assert_raises_str(ValueError, 'page_rect width/height must be a positive integer'):
+            page_job.save_image(file, 'png', page_rect=(0, 0, 0, 48))
+        assert_equal(file.getvalue(), b'')
+
+    def test_render_pyramid(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode(wait=False)
+        pixel_format = PixelFormatGrey()
+        pixel_format.rows_top_to_bottom = True
+        pixel_format.y_top_to_bottom = True
+        tiles = {}
+        def sink(level, column, row, size, data):
+            tiles[level, column, row] = (size, data)
+        timings = page_job.render_pyramid(RENDER_COLOR, pixel_format, 32, sink=sink, row_alignment=4)
+        assert_true(page_job.is_done)
+        assert_equal(
+            [(level, size, n) for (level, size, n, seconds) in timings],
+            [(0, (1, 1), 1), (1, (2, 2), 1), (2, (4, 3), 1), (3, (8, 6), 1), (4, (16, 12), 1), (5, (32, 24), 1), (6, (64, 48), 4)]
+        )
+        for (level, size, n, seconds) in timings:
+            assert_true(seconds >= 0)
+        assert_equal(len(tiles), 10)
+        page_rect = (0, 0, 64, 48)
+        assert_equal(tiles[6, 0, 0], ((32, 32, 32), page_job.render(RENDER_COLOR, page_rect, (0, 0, 32, 32), pixel_format)))
+        assert_equal(tiles[6, 1, 1], ((32, 16, 32), page_job.render(RENDER_COLOR, page_rect, (32, 32, 32, 16), pixel_format)))
+        assert_equal(tiles[1, 0, 0], ((2, 2, 4), page_job.render(RENDER_COLOR, (0, 0, 2, 2), (0, 0, 2, 2), pixel_format, 4)))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            timings = page_job.render_pyramid(RENDER_COLOR, pixel_format, 32, directory=tmpdir, row_alignment=4)
+            assert_equal(len(timings), 7)
+            assert_equal(sorted(os.listdir(tmpdir)), [str(level) for level in range(7)])
+            assert_equal(sorted(os.listdir(os.path.join(tmpdir, '6'))), ['0_0.pgm', '0_1.pgm', '1_0.pgm', '1_1.pgm'])
+            with open(os.path.join(tmpdir, '6', '1_1.pgm'), 'rb') as file:
+                assert_equal(file.read(), b'P5\n32 16\n255\n' + tiles[6, 1, 1][1])
+            with open(os.path.join(tmpdir, '1', '0_0.pgm'), 'rb') as file:
+                data = tiles[1, 0, 0][1]
+                assert_equal(file.read(), b'P5\n2 2\n255\n' + data[0:2] + data[4:6])
+            pixel_format = PixelFormatGrey()
+            page_job.render_pyramid(RENDER_COLOR, pixel_format, 32, directory=tmpdir)
+            with open(os.path.join(tmpdir, '6', '1_1.pgm'), 'rb') as file:
+                assert_equal(file.read(), b'P5\n32 16\n255\n' + tiles[6, 1, 1][1])
+        finally:
+            shutil.rmtree(tmpdir)
+        with assert_raises_str(ValueError, 'exactly one of directory and sink must be specified'):
+            page_job.render_pyramid(RENDER_COLOR, pixel_format)
+        with assert_raises_str(ValueError, 'pixel_format cannot be saved as a PNM image'):
+            page_job.render_pyramid(RENDER_COLOR, PixelFormatRgb('BGR'), directory=os.devnull)
+        with assert_raises_str(ValueError, 'tile_size must be a positive integer'):
+            page_job.render_pyramid(RENDER_COLOR, pixel_format, 0, sink=sink)
+
+    def test_render_threads(self):
+        context = Context()
+        page_jobs = []
+        for filename in 'test0.djvu', 'test1.djvu':
+            document = context.new_document(FileUri(images + filename))
+            document.decoding_job.wait()
+            page_jobs += [page.decode() for page in document.pages]
+        assert_equal(len(page_jobs), 3)
+        def render(page_job):
+            (w, h) = page_job.size
+            rect = (0, 0, w // 8, h // 8)
+            return page_job.render(RENDER_COLOR, rect, rect, PixelFormatRgb())
+        expected = [render(page_job) for page_job in page_jobs]
+        errors = []
+        def render_many(n):
+            # Each thread renders its own page job; the first two threads
+            # render different pages of the same document.
+            try:
+                for i in range(20):
+                    assert_equal(render(page_jobs[n]), expected[n])
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=render_many, args=(n,)) for n in range(len(page_jobs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+
 class test_thumbnails(TestCase):
 
     def test(self):
@@ -599,6 +1379,211 @@ class test_thumbnails(TestCase):
         assert_is(pixels, buffer)
         s = array_tobytes(buffer[:15])
         assert_equal(s, b'\xFF\xEB\xA7\xF2\xFF\xFF\xBF\x86\xBE\xFF\xFF\xE7\xD6\xE7\xFF')
+        pool = BufferPool()
+        (w, h, r), pixels = thumbnail.render((5, 5), PixelFormatGrey(), buffer=pool)
+        assert_equal((w, h, r), (5, 3, 5))
+        assert_equal(type(pixels), PooledBuffer)
+        assert_is(pixels.pool, pool)
+        assert_equal(len(pixels), 15)
+        assert_equal(memoryview(pixels).tobytes(), b'\xFF\xEB\xA7\xF2\xFF\xFF\xBF\x86\xBE\xFF\xFF\xE7\xD6\xE7\xFF')
+
+    def test_render_threads(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        thumbnail = document.pages[0].thumbnail
+        assert_equal(thumbnail.calculate(), JobOK)
+        expected = thumbnail.render((5, 5), PixelFormatGrey())
+        errors = []
+        def render_many():
+            try:
+                for i in range(50):
+                    assert_equal(thumbnail.render((5, 5), PixelFormatGrey()), expected)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=render_many) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+
+class test_buffer_pools(TestCase):
+
+    def test_bad_new(self):
+        with assert_raises_str(TypeError, "cannot create 'djvu.decode.PooledBuffer' instances"):
+            PooledBuffer()
+        with assert_raises_str(ValueError, 'max_size must be a non-negative integer or None'):
+            BufferPool(-1)
+
+    def test_get(self):
+        pool = BufferPool()
+        assert_is(pool.max_size, None)
+        assert_equal(pool.size, 0)
+        buffer = pool.get(10)
+        assert_equal(type(buffer), PooledBuffer)
+        assert_is(buffer.pool, pool)
+        assert_equal(len(buffer), 10)
+        memview = memoryview(buffer)
+        memview[:3] = b'abc'
+        del memview
+        assert_equal(pool.size, 0)
+        del buffer
+        assert_equal(pool.size, 10)
+        buffer = pool.get(10)
+        assert_equal(pool.size, 0)
+        assert_equal(memoryview(buffer).tobytes()[:3], b'abc')
+        other_buffer = pool.get(20)
+        assert_equal(len(other_buffer), 20)
+        del buffer, other_buffer
+        assert_equal(pool.size, 30)
+        pool.clear()
+        assert_equal(pool.size, 0)
+        with assert_raises_str(ValueError, 'size must be a non-negative integer'):
+            pool.get(-1)
+
+    def test_max_size(self):
+        pool = BufferPool(15)
+        assert_equal(pool.max_size, 15)
+        buffers = [pool.get(10), pool.get(10)]
+        del buffers
+        assert_equal(pool.size, 10)
+
+    def test_render(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        pixel_format = PixelFormatRgb()
+        page_rect = (0, 0, 64, 48)
+        expected = page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        pool = BufferPool()
+        for i in range(3):
+            data = page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format, buffer=pool)
+            assert_equal(type(data), PooledBuffer)
+            assert_equal(memoryview(data).tobytes(), expected)
+            del data
+            assert_equal(pool.size, len(expected))
+        for (rect, data) in page_job.render_tiles(RENDER_COLOR, page_rect, 32, pixel_format, 1, pool):
+            assert_equal(type(data), PooledBuffer)
+            assert_equal(memoryview(data).tobytes(), page_job.render(RENDER_COLOR, page_rect, rect, pixel_format))
+
+class test_render_caches(TestCase):
+
+    def test_bad_new(self):
+        with assert_raises_str(ValueError, 'max_size must be a non-negative integer'):
+            RenderCache(-1)
+
+    def test_render(self):
+        context = Context()
+        assert_is(context.render_cache, None)
+        cache = context.render_cache = RenderCache(3 * 64 * 48 * 3)
+        assert_is(context.render_cache, cache)
+        assert_equal(cache.max_size, 3 * 64 * 48 * 3)
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        pixel_format = PixelFormatRgb()
+        page_rect = (0, 0, 64, 48)
+        data = page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (0, 1, 0))
+        assert_equal((len(cache), cache.size), (1, len(data)))
+        assert_is(page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format), data)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+        buffer = bytearray(len(data))
+        assert_is(page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format, buffer=buffer), buffer)
+        assert_equal(bytes(buffer), data)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (2, 1, 0))
+        other_pixel_format = PixelFormatRgb()
+        other_pixel_format.gamma = 1.0
+        page_job.render(RENDER_COLOR, page_rect, page_rect, other_pixel_format)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (2, 2, 0))
+        for x in (16, 32):
+            page_job.render(RENDER_COLOR, (x, 0, 64, 48), (x, 0, 64, 48), pixel_format)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (2, 4, 1))
+        assert_equal((len(cache), cache.size), (3, 3 * len(data)))
+        page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        assert_equal((cache.hits, cache.misses, cache.evictions), (2, 5, 2))
+        other_document = context.new_document(FileUri(images + 'test1.djvu'))
+        cache.invalidate(other_document.pages[0])
+        cache.invalidate(other_document)
+        assert_equal(len(cache), 3)
+        cache.invalidate(document.pages[0])
+        assert_equal((len(cache), cache.size), (0, 0))
+        page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        cache.invalidate(document)
+        assert_equal((len(cache), cache.size), (0, 0))
+        page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        cache.invalidate()
+        assert_equal((len(cache), cache.size), (0, 0))
+        with assert_raises_str(TypeError, 'target must be a Document, a Page or None'):
+            cache.invalidate(42)
+        context.render_cache = None
+        page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format)
+        assert_equal(len(cache), 0)
+
+    def test_rotation(self):
+        context = Context()
+        cache = context.render_cache = RenderCache(1 << 20)
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        pixel_format = PixelFormatRgb()
+        rect = (0, 0, 48, 48)
+        data = page_job.render(RENDER_COLOR, rect, rect, pixel_format)
+        page_job.rotation = 90
+        rotated_data = page_job.render(RENDER_COLOR, rect, rect, pixel_format)
+        assert_equal((cache.hits, cache.misses), (0, 2))
+        assert_not_equal(rotated_data, data)
+        context.render_cache = None
+        assert_equal(page_job.render(RENDER_COLOR, rect, rect, pixel_format), rotated_data)
+        page_job.rotation = 0
+        assert_equal(page_job.render(RENDER_COLOR, rect, rect, pixel_format), data)
+
+    def test_pixel_format_keys(self):
+        context = Context()
+        cache = context.render_cache = RenderCache(1 << 20)
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        rect = (0, 0, 64, 48)
+        palette = dict(((i, j, k), i + 7 * j + 37 * k) for i in range(6) for j in range(6) for k in range(6))
+        other_palette = dict(((i, j, k), 0xFF - v) for ((i, j, k), v) in palette.items())
+        for pixel_format in [PixelFormatPalette(palette), PixelFormatPalette(other_palette), PixelFormatRgb('BGR')]:
+            page_job.render(RENDER_COLOR, rect, rect, pixel_format)
+        assert_equal((cache.hits, cache.misses), (0, 3))
+        page_job.render(RENDER_COLOR, rect, rect, PixelFormatPalette(palette))
+        page_job.render(RENDER_COLOR, rect, rect, PixelFormatRgb('BGR'))
+        assert_equal((cache.hits, cache.misses), (2, 3))
+
+    def test_threads(self):
+        context = Context()
+        cache = context.render_cache = RenderCache(4 * 16 * 48 * 3)
+        pool = BufferPool()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        page_job = document.pages[0].decode()
+        pixel_format = PixelFormatRgb()
+        page_rect = (0, 0, 64, 48)
+        rects = [(x, 0, 16, 48) for x in range(0, 64, 16)]
+        expected = [page_job.render(RENDER_COLOR, page_rect, rect, pixel_format) for rect in rects]
+        # Concurrent rendering of the same page job is not guaranteed to be
+        # safe, so the threads only hit the cache, which is filled up already.
+        hits = cache.hits
+        errors = []
+        def render():
+            try:
+                for i in range(50):
+                    for rect, data in zip(rects, expected):
+                        assert_equal(page_job.render(RENDER_COLOR, page_rect, rect, pixel_format), data)
+                        buffer = page_job.render(RENDER_COLOR, page_rect, rect, pixel_format, buffer=pool)
+                        assert_equal(memoryview(buffer).tobytes(), data)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=render) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+        assert_equal((len(cache), cache.size), (4, 4 * 16 * 48 * 3))
+        assert_equal(cache.evictions, 0)
+        assert_equal((cache.hits - hits, cache.misses), (8 * 50 * 4 * 2, 4))
 
 @testcase
 def test_jobs():
@@ -609,6 +1594,158 @@ def test_jobs():
     with assert_raises_str(TypeError, "cannot create 'djvu.decode.DocumentDecodingJob' instances"):
         DocumentDecodingJob()
 
+@testcase
+def test_wait_jobs():
+    context = Context()
+    document = context.new_document('dummy://dummy.djvu')
+    message = document.get_message()
+    assert_equal(type(message), NewStreamMessage)
+    assert_false(document.decoding_job.wait(timeout=0.01))
+    assert_equal(wait_any([document], timeout=0.01), ([], [document]))
+    assert_equal(wait_all([document], timeout=0), ([], [document]))
+    other_document = context.new_document(FileUri(images + 'test0.djvu'))
+    assert_equal(wait_any([document, other_document]), ([other_document], [document]))
+    try:
+        with open(images + 'test1.djvu', 'rb') as fp:
+            message.stream.write(fp.read())
+    finally:
+        message.stream.close()
+    assert_true(document.decoding_job.wait(timeout=10))
+    jobs = [page.decode(wait=False) for page in other_document.pages]
+    assert_equal(wait_all(jobs + [document]), (jobs + [document], []))
+    for job in jobs:
+        assert_true(job.is_done)
+        assert_true(job.wait(timeout=0))
+    with assert_raises_str(TypeError, 'jobs must be Job or Document instances'):
+        wait_any([42])
+
+@testcase
+def test_job_futures():
+    if not py3k:
+        raise SkipTest('concurrent.futures requires Python 3')
+    from concurrent.futures import Future, wait
+    context = Context()
+    document = context.new_document(FileUri(images + 'test0.djvu'))
+    future = document.decoding_job.as_future()
+    assert_is_instance(future, Future)
+    assert_equal(type(future.result(timeout=10)), DocumentDecodingJob)
+    jobs = [page.decode(wait=False) for page in document.pages]
+    futures = [job.as_future() for job in jobs]
+    (done, pending) = wait(futures, timeout=10)
+    assert_equal(len(done), len(jobs))
+    assert_equal([future.result() for future in futures], jobs)
+    assert_false(futures[0].cancel())
+    with tempfile.TemporaryFile() as file:
+        job = document.save(file, wait=False)
+        future = job.as_future()
+        assert_is(future.result(timeout=10), job)
+        file.seek(0)
+        assert_equal(file.read(8), b'AT&TFORM')
+
+class test_asyncio(TestCase):
+
+    def setUp(self):
+        if not py3k:
+            raise SkipTest('asyncio requires Python 3')
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        import asyncio
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, func, *args):
+        # The *_async() methods must be called with the event loop running.
+        future = self.loop.create_future()
+        def copy_result(inner):
+            if inner.cancelled():
+                future.cancel()
+            elif inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        def call():
+            try:
+                inner = func(*args)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                inner.add_done_callback(copy_result)
+        self.loop.call_soon(call)
+        return self.loop.run_until_complete(future)
+
+    def test_wait(self):
+        import asyncio
+        run = self.run_async
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        assert_is(run(document.decoding_job.wait_async), None)
+        assert_true(document.decoding_done)
+        page = document.pages[0]
+        assert_is(run(page.get_info_async), None)
+        assert_equal((page.width, page.height), (2550, 3300))
+        jobs = [page.decode(wait=False) for page in document.pages]
+        run(lambda: asyncio.gather(*[job.wait_async() for job in jobs]))
+        for job in jobs:
+            assert_true(job.is_done)
+        run(page.thumbnail.wait_async)
+        assert_equal(page.thumbnail.status, JobOK)
+        for obj in document.outline, document.annotations, page.text, page.annotations:
+            run(obj.wait_async)
+            obj.sexpr
+
+    def test_no_running_loop(self):
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        with assert_raises(RuntimeError):
+            document.decoding_job.wait_async()
+
+    def test_messages(self):
+        run = self.run_async
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        message = run(document.get_message_async)
+        assert_equal(type(message), DocInfoMessage)
+        page_job = document.pages[0].decode()
+        iterator = page_job.__aiter__()
+        assert_is(iterator.__aiter__(), iterator)
+        message = run(iterator.__anext__)
+        assert_is_instance(message, Message)
+        assert_is(message.job, page_job)
+
+    def test_cancelled_message(self):
+        run = self.run_async
+        context = Context()
+        document = context.new_document(FileUri(images + 'test1.djvu'))
+        document.decoding_job.wait()
+        def cancel():
+            document.get_message_async().cancel()
+            return document.decoding_job.wait_async()
+        run(cancel)
+        # The message was not lost:
+        message = run(document.get_message_async)
+        assert_equal(type(message), DocInfoMessage)
+
+    def test_save(self):
+        run = self.run_async
+        context = Context()
+        document = context.new_document(FileUri(images + 'test0.djvu'))
+        document.decoding_job.wait()
+        with tempfile.TemporaryFile() as file:
+            job = document.save(file, wait=False)
+            def cancel():
+                job.wait_async().cancel()
+                return document.decoding_job.wait_async()
+            run(cancel)
+            # Cancelling didn't close the file while the job was running:
+            assert_is(run(job.wait_async), None)
+            assert_true(job.is_done)
+            assert_false(job.is_error)
+            file.seek(0)
+            assert_equal(file.read(8), b'AT&TFORM')
+
 class test_affine_transforms(TestCase):
 
     def test_bad_args(self):
@@ -895,8 +2032,10 @@ def test_wildcard_import():
         sorted(ns.keys()), [
             'AffineTransform',
             'Annotations',
+            'BufferPool',
             'ChunkMessage',
             'Context',
+            'ContextPool',
             'DDJVU_VERSION',
             'DOCUMENT_TYPE_BUNDLED',
             'DOCUMENT_TYPE_INDIRECT',
@@ -917,9 +2056,11 @@ def test_wildcard_import():
             'FILE_TYPE_PAGE',
             'FILE_TYPE_THUMBNAILS',
             'File',
+            'FileInfos',
             'FileURI',
             'FileUri',
             'Hyperlinks',
+            'ImageBuffer',
             'InfoMessage',
             'Job',
             'JobDone',
@@ -948,6 +2089,7 @@ def test_wildcard_import():
             'Page',
             'PageAnnotations',
             'PageInfoMessage',
+            'PageInfos',
             'PageJob',
             'PageText',
             'PixelFormat',
@@ -956,15 +2098,18 @@ def test_wildcard_import():
             'PixelFormatPalette',
             'PixelFormatRgb',
             'PixelFormatRgbMask',
+            'PooledBuffer',
             'ProgressMessage',
             'RENDER_BACKGROUND',
             'RENDER_BLACK',
             'RENDER_COLOR',
             'RENDER_COLOR_ONLY',
             'RENDER_FOREGROUND',
+            'RENDER_FOREGROUND_ALPHA',
             'RENDER_MASK_ONLY',
             'RedisplayMessage',
             'RelayoutMessage',
+            'RenderCache',
             'SaveJob',
             'Stream',
             'TEXT_DETAILS_ALL',
@@ -977,7 +2122,9 @@ def test_wildcard_import():
             'TEXT_DETAILS_WORD',
             'Thumbnail',
             'ThumbnailMessage',
-            'cmp_text_zone'
+            'cmp_text_zone',
+            'wait_all',
+            'wait_any'
         ]
     )
 
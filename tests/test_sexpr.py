@@ -21,6 +21,7 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 
 if sys.version_info >= (3, 3):
     import collections.abc as collections_abc
@@ -762,6 +763,33 @@ class test_expression_writer_nonascii(test_expression_writer_ascii):
     repr = r'"\305\274\303\263\305\202w"'
     urepr = r'"żółw"'
 
+@testcase
+def test_threads():
+    names = ['eggs{0}'.format(i) for i in range(100)]
+    results = []
+    errors = []
+    def build():
+        try:
+            symbols = [Symbol(name) for name in names]
+            for i in range(20):
+                expr = Expression([symbols, 42, ['ham', u('ветчина')]])
+                expr[0].append(Symbol('spam'))
+                parsed = Expression.from_string(expr.as_string())
+                assert_equal(parsed, expr)
+            results.append(symbols)
+        except Exception as exc:
+            errors.append(exc)
+    threads = [threading.Thread(target=build) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(errors, [])
+    assert_equal(len(results), 8)
+    for symbols in results:
+        for symbol, other_symbol in zip(symbols, results[0]):
+            assert_is(symbol, other_symbol)
+
 @testcase
 def test_version():
     assert_is_instance(__version__, str)